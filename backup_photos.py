@@ -1,7 +1,41 @@
 import argparse
+import logging
 import os
+import queue
 import subprocess
 import sys
+import threading
+from datetime import datetime
+
+import requests
+
+import google_downloader
+import google_uploader
+from dedup import DestinationIndex
+from io_scheduler import WINDOW, group_by_directory
+from metadata_cache import MetadataCache
+from photo_stages import (
+    DestinationPlanner,
+    MetadataExtractor,
+    PhotoRecord,
+    Resizer,
+    Transferrer,
+    scan,
+)
+from photos_api import upload_all
+
+# Maximum number of files waiting between two stages.
+QUEUE_SIZE = 64
+RESIZE_WORKERS = 4
+
+# Sent through a queue after the last item.
+DONE = object()
+
+# Directory in Google_Photos for downloads that were not renamed, because a photo
+# with the same timestamp was already there.
+SKIPPED_DIRNAME = "Skipped"
+
+logger = logging.getLogger(__name__)
 
 
 def run_script(script_name, args):
@@ -14,6 +48,230 @@ def run_script(script_name, args):
         print(result.stdout)
 
 
+def set_aside(filepath, directory):
+    """Move a file into directory, adding a numeric suffix if its name is taken."""
+    os.makedirs(directory, exist_ok=True)
+    base, ext = os.path.splitext(os.path.basename(filepath))
+    destination = os.path.join(directory, base + ext)
+    suffix = 0
+    while os.path.exists(destination):
+        suffix += 1
+        destination = os.path.join(directory, f"{base}_{suffix}{ext}")
+    os.replace(filepath, destination)
+    logger.info(f"Set aside {filepath} in {directory}.")
+
+
+def stage(inbox, process, outbox=None, workers=1, finish=None):
+    """Start worker threads that apply process to every item of inbox.
+
+    process returns an iterable of items to pass on to outbox. The workers stop at
+    the first DONE from inbox, calling finish if given, and once all of them have
+    stopped, DONE is sent on to outbox. Returns the threads.
+    """
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                # Let the other workers of this stage see it too.
+                inbox.put(DONE)
+                break
+            try:
+                results = process(item)
+            except Exception as e:
+                logger.warning(f"Failed to process {item}. Error: {e}")
+                continue
+            if outbox is not None:
+                for result in results:
+                    outbox.put(result)
+        if finish is not None:
+            finish()
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and outbox is not None:
+            outbox.put(DONE)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def run_pipeline(args):
+    """Download, rename and resize photos as a streaming pipeline.
+
+    Stages are connected by bounded queues, so a fast stage waits for a slow one
+    instead of piling up work, and the run takes about as long as its slowest stage.
+    Returns the paths of the resized photos.
+    """
+    google_dir = os.path.join(args.external_hd, "Google_Photos")
+    phone_photos_dir = os.path.join(args.external_hd, "Phone_Photos")
+    if not os.path.exists(google_dir):
+        os.makedirs(google_dir)
+
+    # Sources are renamed one after the other, in this order, so that which file
+    # gets a name never depends on which producer is faster. Downloads are already
+    # on disk, so their queue only holds paths and need not be bounded: they carry
+    # on while the phone is being renamed.
+    phone_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    google_queue = queue.Queue()
+    resize_queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+    # Sources and how to rename them. Photos from the phone are copied, with
+    # identical files skipped and same-second shots kept side by side. Phone_Photos
+    # replaces files with the same timestamp. Google downloads are moved, unless a
+    # photo with the same timestamp is already there, in which case they are set
+    # aside in Google_Photos/Skipped; any recompressed copy that still gets through
+    # shows up in the near-duplicate report.
+    sources = {
+        "phone": ({}, False),
+        "phone_photos": ({"force_overwrite": True}, False),
+        "google": ({"skip_existing": True}, True),
+    }
+    skipped_dir = os.path.join(google_dir, SKIPPED_DIRNAME)
+
+    # A producer that fails still ends its queue, so the run finishes with what it
+    # has, and run_pipeline reports the failure afterwards.
+    failures = []
+
+    def producer(outbox, produce):
+        def run():
+            try:
+                produce(outbox)
+            except Exception as e:
+                logger.error(f"{produce.__name__} failed. Error: {e}")
+                failures.append((produce.__name__, e))
+            finally:
+                outbox.put(DONE)
+
+        return threading.Thread(target=run, daemon=True)
+
+    def scan_phone(outbox):
+        for record in scan(args.phone_device):
+            outbox.put((record, "phone"))
+        if os.path.isdir(phone_photos_dir):
+            for record in scan(phone_photos_dir):
+                outbox.put((record, "phone_photos"))
+
+    def download(outbox):
+        # Downloads left behind by an interrupted run have not been renamed yet.
+        for record in scan(google_dir, recursive=False):
+            outbox.put((record, "google"))
+        start_date = datetime.strptime(args.start_date, "%Y-%m-%d")
+        end_date = datetime.strptime(args.end_date, "%Y-%m-%d")
+        session = requests.Session()
+        session.credentials = google_downloader.authenticate()
+        media_items = google_downloader.list_media_items(session, start_date, end_date)
+        print(f"Found {len(media_items)} media items to download")
+        failed = google_downloader.download_all(
+            session,
+            media_items,
+            google_dir,
+            on_downloaded=lambda path: outbox.put((PhotoRecord(path), "google")),
+        )
+        if failed:
+            raise RuntimeError(f"{failed} downloads failed. Run again to retry them.")
+
+    # The renamer allocates names in order, so it runs on a single thread. Its
+    # stages are created there, since sqlite connections are per thread.
+    renamer = {}
+    # Renamed records are transferred WINDOW at a time, grouped by year directory,
+    # so that writes to the external drive stay together. Names are taken as soon
+    # as they are planned, so later records cannot be given the same one.
+    queued = []
+
+    def transfer_queued():
+        group_by_directory(queued, lambda item: item[0].destination)
+        # Taken off the queue first, so that nothing is transferred twice.
+        window = queued[:]
+        queued.clear()
+        transferred = []
+        for record, transferrer in window:
+            try:
+                record = transferrer.process(record)
+            except Exception as e:
+                logger.warning(f"Failed to transfer {record.path}. Error: {e}")
+                continue
+            if record is not None:
+                transferred.append(record)
+        return transferred
+
+    def rename(item):
+        record, source = item
+        if not renamer:
+            renamer["cache"] = MetadataCache.in_directory(args.external_hd)
+            renamer["extractor"] = MetadataExtractor(renamer["cache"])
+            destinations = DestinationIndex(renamer["cache"])
+            for name, (options, delete_originals) in sources.items():
+                planner = DestinationPlanner(
+                    args.external_hd, destinations=destinations, **options
+                )
+                renamer[name] = (planner, Transferrer(delete_originals))
+        planner, transferrer = renamer[source]
+        record = renamer["extractor"].process(record)
+        if record is None:
+            return []
+        planned = planner.process(record)
+        if planned is None:
+            if source == "google":
+                set_aside(record.path, skipped_dir)
+            return []
+        queued.append((planned, transferrer))
+        return transfer_queued() if len(queued) >= WINDOW else []
+
+    def finish_renaming():
+        # Runs before DONE is sent on, so the last records still get resized.
+        for record in transfer_queued():
+            resize_queue.put(record)
+        if renamer:
+            renamer["cache"].close()
+
+    # Renditions are replaced, as in a re-run they are of the same photos.
+    resizer = Resizer([(1200, args.local_backup, None)], force_overwrite=True)
+    resized_files = set()
+    resized_lock = threading.Lock()
+
+    def resize(record):
+        # The files were only just renamed, so there is nothing to find in a cache.
+        resizer.process(record)
+        with resized_lock:
+            resized_files.update(record.outputs)
+        return []
+
+    producers = [
+        producer(phone_queue, scan_phone),
+        producer(google_queue, download),
+    ]
+    for thread in producers:
+        thread.start()
+    merged_queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+    def merge():
+        for inbox in (phone_queue, google_queue):
+            while True:
+                item = inbox.get()
+                if item is DONE:
+                    break
+                merged_queue.put(item)
+        merged_queue.put(DONE)
+
+    threads = [threading.Thread(target=merge, daemon=True)]
+    threads[0].start()
+    threads += stage(merged_queue, rename, resize_queue, finish=finish_renaming)
+    threads += stage(resize_queue, resize, workers=RESIZE_WORKERS)
+    for thread in producers + threads:
+        thread.join()
+
+    if failures:
+        names = ", ".join(name for name, _ in failures)
+        error = RuntimeError(f"Not every photo was processed: {names} failed.")
+        raise error from failures[0][1]
+    return resized_files
+
+
 def main():
     parser = argparse.ArgumentParser(description="Backup and manage your photos.")
     parser.add_argument(
@@ -48,63 +306,34 @@ def main():
     )
     args = parser.parse_args()
 
-    # 1. Download photos from Google Photos between specified dates
-    print("Downloading photos from Google Photos...")
-    google_downloader_args = [
-        args.start_date,
-        args.end_date,
-        os.path.join(args.external_hd, "Google_Photos"),
-    ]
-    run_script("google_downloader.py", google_downloader_args)
-
-    # 2. Copy photos from phone/device to external hard drive
-    print("Copying photos from phone/device to external hard drive...")
-    image_renamer_args = [
-        "--input-directory",
-        args.phone_device,
-        "--output-dir",
-        os.path.join(args.external_hd),
-        "--recursive",
-    ]
-    run_script("image_renamer.py", image_renamer_args)
-
-    # 3. Copy/rename all photos to a single location and overwrite duplicates
-    print("Renaming and consolidating all photos to a single location...")
-    image_renamer_args = [
-        "--input-directory",
-        os.path.join(args.external_hd, "Google_Photos"),
-        "--output-dir",
-        args.external_hd,
-        "--overwrite",
-        "--delete-orig",
-        "--recursive",
-    ]
-    run_script("image_renamer.py", image_renamer_args)
+    logging.basicConfig(
+        handlers=[logging.FileHandler("debug.log"), logging.StreamHandler()],
+        format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
+        datefmt="%H:%M:%S",
+        level=logging.INFO,
+    )
 
-    # Run renamer again for phone photos
-    image_renamer_args = [
-        "--input-directory",
-        os.path.join(args.external_hd, "Phone_Photos"),
-        "--output-dir",
-        args.external_hd,
-        "--overwrite",
-        "--recursive",
-    ]
-    run_script("image_renamer.py", image_renamer_args)
+    # 1-4. Download, rename/consolidate and resize, all at the same time: each file
+    # moves on to the next stage as soon as it is ready.
+    print("Downloading, renaming and resizing photos...")
+    try:
+        resized_files = run_pipeline(args)
+    except RuntimeError as e:
+        # Deleting from Google Photos is only safe once everything is backed up.
+        print(f"{e} Stopping before deleting or uploading anything.")
+        sys.exit(1)
 
-    # 4. Resize photos and back them up to local storage
-    print("Resizing photos and backing them up to local storage...")
-    image_resizer_args = [
+    # Google Photos downloads are recompressed, so they are not caught by the
+    # renamer's content check. Report the visually identical copies instead.
+    print("Looking for near-duplicate photos...")
+    near_duplicates_args = [
         "--input-directory",
         args.external_hd,
-        "--output-dir",
-        args.local_backup,
-        "--resize_max_dim_pix",
-        "1200",
-        "--overwrite",
         "--recursive",
+        "--report",
+        os.path.join(args.external_hd, "near_duplicates.json"),
     ]
-    run_script("image_resizer.py", image_resizer_args)
+    run_script("near_duplicates.py", near_duplicates_args)
 
     # 5. MANUAL: Confirm before deleting photos from Google Photos
     confirm = input(
@@ -116,10 +345,16 @@ def main():
     else:
         print("Skipping deletion of photos from Google Photos.")
 
-    # 6. Upload resized photos back to Google Photos
+    # 6. Upload resized photos back to Google Photos. This waits for the deletion
+    # above, which would otherwise also remove the new uploads.
     print("Uploading resized photos to Google Photos...")
-    google_uploader_args = [args.local_backup]
-    run_script("google_uploader.py", google_uploader_args)
+    session = requests.Session()
+    session.credentials = google_uploader.authenticate()
+    successful_uploads, failed_uploads = upload_all(session, sorted(resized_files))
+    google_uploader.write_retry_queue(failed_uploads)
+    print(
+        f"Upload completed: {successful_uploads} files successfully uploaded, {len(failed_uploads)} files failed."
+    )
 
     print("Backup process completed.")
 
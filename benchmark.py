@@ -0,0 +1,570 @@
+import argparse
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from PIL import Image
+
+from date_extraction import extract_date_time
+from dedup import DestinationIndex, plan_destination
+from exif_date_adder import stamp
+from file_hash import hash_files
+from file_scanner import scan_files
+from file_transfer import copy_file
+from photo_stages import PhotoRecord, Resizer
+
+img_formats = [".png", ".jpg", ".jpeg"]
+
+RESULTS_VERSION = 1
+CORPUS_FILENAME = "corpus.json"
+
+STAGES = [
+    "scan",
+    "exif",
+    "hash",
+    "hash_fast",
+    "quick_hash",
+    "plan",
+    "copy",
+    "resize",
+    "exif_rewrite",
+]
+
+# The slow stages only process this many files unless --limit is given.
+DEFAULT_LIMITS = {"resize": 500, "exif_rewrite": 2000}
+
+# Largest dimension the resize stage resizes to. Only images larger than this are
+# timed, since smaller ones are copied rather than resized.
+RESIZE_MAX_DIM = 1200
+
+# Distinct images rendered per resolution and format. Every file is one of these
+# with its own EXIF date and a comment of random length, so files differ in size
+# and content without encoding a new image for each one.
+TEMPLATES_PER_KIND = 4
+
+
+def parse_resolution(value):
+    width, _, height = value.partition("x")
+    if not width.isdigit() or not height.isdigit():
+        raise argparse.ArgumentTypeError(f"Expected WIDTHxHEIGHT, got {value}")
+    return int(width), int(height)
+
+
+def render_template(rng, resolution, image_format):
+    """Encode a smooth random image, without any metadata, at resolution."""
+    # Upscaled noise compresses about as well as a photo, unlike pure noise.
+    base = Image.frombytes("RGB", (16, 12), rng.randbytes(16 * 12 * 3))
+    image = base.resize(resolution, Image.Resampling.BICUBIC)
+    output = io.BytesIO()
+    image.save(output, image_format, quality=90)
+    return output.getvalue()
+
+
+def exif_block(date_time):
+    """Return an EXIF block, with the Exif header, holding only DateTimeOriginal."""
+    exif = Image.Exif()
+    exif.get_ifd(0x8769)[0x9003] = date_time
+    return exif.tobytes()
+
+
+def jpeg_file(template, date_time, padding):
+    segments = b""
+    if date_time:
+        app1 = exif_block(date_time)
+        segments += b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+    segments += b"\xff\xfe" + struct.pack(">H", len(padding) + 2) + padding
+    return template[:2] + segments + template[2:]
+
+
+def png_chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data)
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def png_file(template, date_time, padding):
+    # Insert after the signature and IHDR chunk, which are 8 + 25 bytes long.
+    chunks = png_chunk(b"tEXt", b"Comment\x00" + padding)
+    if date_time:
+        chunks += png_chunk(b"eXIf", exif_block(date_time)[len(b"Exif\x00\x00") :])
+    return template[:33] + chunks + template[33:]
+
+
+def corpus_path(directory, index, depth, fanout, files_per_directory, extension):
+    """Return the path of file index in a tree depth levels deep."""
+    parts = []
+    directory_index = index // files_per_directory
+    for _ in range(depth):
+        directory_index, digit = divmod(directory_index, fanout)
+        parts.append(f"d{digit:02d}")
+    return os.path.join(directory, *reversed(parts), f"IMG_{index:07d}{extension}")
+
+
+def generate_corpus(args):
+    """Write a reproducible synthetic corpus. The same arguments give the same files."""
+    rng = random.Random(args.seed)
+    templates = {}
+    for resolution in args.resolutions:
+        for image_format in ("JPEG", "PNG"):
+            templates[resolution, image_format] = [
+                render_template(rng, resolution, image_format)
+                for _ in range(TEMPLATES_PER_KIND)
+            ]
+
+    start = datetime(2010, 1, 1)
+    dates = []
+    paths = []
+    num_bytes = 0
+    for index in range(args.files):
+        if paths and rng.random() < args.duplicates:
+            source = rng.choice(paths)
+            path = corpus_path(
+                args.corpus_directory,
+                index,
+                args.depth,
+                args.fanout,
+                args.files_per_directory,
+                os.path.splitext(source)[1],
+            )
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(source, path)
+            num_bytes += os.path.getsize(path)
+            paths.append(path)
+            continue
+
+        image_format = "PNG" if rng.random() < args.png else "JPEG"
+        template = rng.choice(templates[rng.choice(args.resolutions), image_format])
+        date_time = None
+        if rng.random() >= args.no_exif:
+            if dates and rng.random() < args.same_second:
+                date_time = rng.choice(dates)
+            else:
+                seconds = rng.randrange(15 * 365 * 24 * 3600)
+                date_time = (start + timedelta(seconds=seconds)).strftime(
+                    "%Y:%m:%d %H:%M:%S"
+                )
+            dates.append(date_time)
+        padding = rng.randbytes(rng.randrange(1024)).hex().encode("ascii")
+
+        if image_format == "PNG":
+            data = png_file(template, date_time, padding)
+            extension = ".png"
+        else:
+            data = jpeg_file(template, date_time, padding)
+            extension = ".jpg"
+        path = corpus_path(
+            args.corpus_directory,
+            index,
+            args.depth,
+            args.fanout,
+            args.files_per_directory,
+            extension,
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        num_bytes += len(data)
+        paths.append(path)
+
+    description = {
+        "seed": args.seed,
+        "files": args.files,
+        "bytes": num_bytes,
+        "resolutions": [f"{width}x{height}" for width, height in args.resolutions],
+        "png": args.png,
+        "no_exif": args.no_exif,
+        "duplicates": args.duplicates,
+        "same_second": args.same_second,
+        "depth": args.depth,
+        "fanout": args.fanout,
+        "files_per_directory": args.files_per_directory,
+    }
+    with open(os.path.join(args.corpus_directory, CORPUS_FILENAME), "w") as f:
+        json.dump(description, f, indent=2)
+    return description
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def bytes_read():
+    """Return the bytes this process has read so far, or None if that is unknown.
+
+    Counts read() calls, so it suits stages that only read part of each file, but not
+    ones that read through mmap.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def larger_than(filepath, max_dim):
+    """Return whether an image's larger side exceeds max_dim. Reads only its header."""
+    try:
+        with Image.open(filepath) as image:
+            return max(image.size) > max_dim
+    except OSError:
+        return False
+
+
+def run_stage(stage, corpus_directory, work_directory, limit):
+    """Time one stage over the corpus. Runs in a fresh process, for its peak RSS."""
+    logging.disable(logging.CRITICAL)
+    logger = logging.getLogger(__name__)
+    files = sorted(scan_files(corpus_directory, img_formats, recursive=True))
+    if stage == "resize":
+        files = (f for f in files if larger_than(f, RESIZE_MAX_DIM))
+        files = list(itertools.islice(files, limit))
+        if not files:
+            raise ValueError(
+                f"The resize stage needs images larger than {RESIZE_MAX_DIM} px. "
+                "Generate the corpus with a --resolution above that."
+            )
+    elif limit is not None:
+        files = files[:limit]
+    num_bytes = sum(os.path.getsize(f) for f in files)
+    output_directory = tempfile.mkdtemp(prefix=f"{stage}_", dir=work_directory)
+
+    if stage == "scan":
+        started = time.perf_counter()
+        files = list(scan_files(corpus_directory, img_formats, recursive=True))
+        seconds = time.perf_counter() - started
+        num_bytes = None  # Only directory entries are read.
+
+    elif stage == "exif":
+        # Only the headers of most files are read.
+        read_before = bytes_read()
+        started = time.perf_counter()
+        for f in files:
+            extract_date_time(f)
+        seconds = time.perf_counter() - started
+        num_bytes = None if read_before is None else bytes_read() - read_before
+
+    elif stage in ("hash", "hash_fast", "quick_hash"):
+        algorithm = "fast" if stage == "hash_fast" else "sha256"
+        read_before = bytes_read()
+        started = time.perf_counter()
+        for _ in hash_files(files, algorithm, quick=stage == "quick_hash"):
+            pass
+        seconds = time.perf_counter() - started
+        if stage == "quick_hash":
+            # Only the ends of each file are read.
+            num_bytes = None if read_before is None else bytes_read() - read_before
+
+    elif stage == "plan":
+        dates = [extract_date_time(f)[2] for f in files]
+        destinations = DestinationIndex()
+        started = time.perf_counter()
+        for f, date_time in zip(files, dates):
+            plan_destination(
+                logger,
+                f,
+                date_time,
+                output_directory,
+                destinations,
+                create_directories=False,
+            )
+        seconds = time.perf_counter() - started
+
+    elif stage == "copy":
+        started = time.perf_counter()
+        for i, f in enumerate(files):
+            copy_file(f, os.path.join(output_directory, f"{i}{os.path.splitext(f)[1]}"))
+        seconds = time.perf_counter() - started
+
+    elif stage == "resize":
+        resizer = Resizer([(RESIZE_MAX_DIM, output_directory, None)])
+        started = time.perf_counter()
+        for f in files:
+            resizer.process(PhotoRecord(f))
+        seconds = time.perf_counter() - started
+
+    elif stage == "exif_rewrite":
+        copies = []
+        for i, f in enumerate(files):
+            copies.append(os.path.join(output_directory, f"{i}{os.path.splitext(f)[1]}"))
+            shutil.copyfile(f, copies[-1])
+        started = time.perf_counter()
+        for f in copies:
+            stamp(f, "2020:02:02 02:02:02", True)
+        seconds = time.perf_counter() - started
+
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    shutil.rmtree(output_directory)
+    return {
+        "stage": stage,
+        "files": len(files),
+        "bytes": num_bytes,
+        "seconds": seconds,
+        "files_per_second": len(files) / seconds if seconds else None,
+        "mb_per_second": num_bytes / 1e6 / seconds if num_bytes and seconds else None,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def git_commit():
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def run_benchmarks(args):
+    with open(os.path.join(args.corpus_directory, CORPUS_FILENAME)) as f:
+        corpus = json.load(f)
+    work_directory = tempfile.mkdtemp(prefix="benchmark_", dir=args.work_directory)
+    results = []
+    try:
+        for stage in args.stages:
+            limit = args.limit if args.limit is not None else DEFAULT_LIMITS.get(stage)
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(
+                    run_stage, stage, args.corpus_directory, work_directory, limit
+                )
+                results.append(future.result())
+            print(format_result(results[-1]), file=sys.stderr)
+    finally:
+        shutil.rmtree(work_directory)
+
+    return {
+        "version": RESULTS_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": corpus,
+        "results": results,
+    }
+
+
+def format_result(result):
+    return (
+        f"{result['stage']:>12}: {result['files']} files in {result['seconds']:.3f} s, "
+        f"{result['files_per_second'] or 0:.1f} files/s, "
+        f"{result['mb_per_second'] or 0:.1f} MB/s, peak RSS {result['peak_rss_kb']} KB"
+    )
+
+
+def compare(baseline, current):
+    """Return lines comparing the throughput of each stage with a baseline."""
+    before = {result["stage"]: result for result in baseline["results"]}
+    lines = []
+    for result in current["results"]:
+        old = before.get(result["stage"])
+        if not old or not old["files_per_second"] or not result["files_per_second"]:
+            continue
+        change = result["files_per_second"] / old["files_per_second"] - 1
+        lines.append(
+            f"{result['stage']:>12}: {old['files_per_second']:.1f} -> "
+            f"{result['files_per_second']:.1f} files/s ({change:+.1%})"
+        )
+    return lines
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic photo corpora and time the tools on them."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate = subparsers.add_parser(
+        "generate", help="Write a reproducible synthetic corpus."
+    )
+    generate.add_argument(
+        "--corpus-dir",
+        "-c",
+        dest="corpus_directory",
+        type=str,
+        required=True,
+        help="Directory to write the corpus to.",
+    )
+    generate.add_argument(
+        "--files",
+        "-n",
+        dest="files",
+        type=int,
+        default=10000,
+        help="Number of files to generate.",
+    )
+    generate.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=1,
+        help="Random seed. The same seed and options give the same corpus.",
+    )
+    generate.add_argument(
+        "--resolution",
+        dest="resolutions",
+        action="append",
+        type=parse_resolution,
+        help="Image size as WIDTHxHEIGHT. May be given several times. Defaults to "
+        "640x480 and 1600x1200.",
+    )
+    generate.add_argument(
+        "--png",
+        dest="png",
+        type=float,
+        default=0.1,
+        help="Fraction of files that are PNG rather than JPEG.",
+    )
+    generate.add_argument(
+        "--no-exif",
+        dest="no_exif",
+        type=float,
+        default=0.1,
+        help="Fraction of files without an EXIF date.",
+    )
+    generate.add_argument(
+        "--duplicates",
+        dest="duplicates",
+        type=float,
+        default=0.05,
+        help="Fraction of files that are exact copies of an earlier file.",
+    )
+    generate.add_argument(
+        "--same-second",
+        dest="same_second",
+        type=float,
+        default=0.05,
+        help="Fraction of files that share their EXIF date with an earlier file.",
+    )
+    generate.add_argument(
+        "--depth",
+        dest="depth",
+        type=int,
+        default=3,
+        help="Number of directory levels above the files.",
+    )
+    generate.add_argument(
+        "--fanout",
+        dest="fanout",
+        type=int,
+        default=10,
+        help="Number of subdirectories per directory.",
+    )
+    generate.add_argument(
+        "--files-per-dir",
+        dest="files_per_directory",
+        type=int,
+        default=100,
+        help="Number of files per leaf directory.",
+    )
+
+    run = subparsers.add_parser("run", help="Time each stage on a corpus.")
+    run.add_argument(
+        "--corpus-dir",
+        "-c",
+        dest="corpus_directory",
+        type=str,
+        required=True,
+        help="Directory of a corpus written by the generate command.",
+    )
+    run.add_argument(
+        "--stage",
+        dest="stages",
+        action="append",
+        choices=STAGES,
+        help="Stage to time. May be given several times. Defaults to all stages.",
+    )
+    run.add_argument(
+        "--limit",
+        dest="limit",
+        type=int,
+        help="Process at most this many files in every stage. By default the resize "
+        "and exif_rewrite stages stop at "
+        + " and ".join(str(limit) for limit in DEFAULT_LIMITS.values())
+        + " files.",
+    )
+    run.add_argument(
+        "--work-dir",
+        dest="work_directory",
+        type=str,
+        help="Directory for the files written by the benchmarks. Defaults to the "
+        "system temporary directory.",
+    )
+    run.add_argument(
+        "--output",
+        "-o",
+        dest="output",
+        type=str,
+        help="Write the results to this JSON file instead of standard output.",
+    )
+    run.add_argument(
+        "--compare",
+        dest="baseline",
+        type=str,
+        help="Compare the throughput of each stage with an earlier results file.",
+    )
+
+    args = parser.parse_args()
+    if args.command == "generate" and not args.resolutions:
+        args.resolutions = [(640, 480), (1600, 1200)]
+    if args.command == "run" and not args.stages:
+        args.stages = STAGES
+    return args
+
+
+def main():
+    args = parse_args()
+    args.corpus_directory = os.path.abspath(args.corpus_directory)
+
+    if args.command == "generate":
+        started = time.perf_counter()
+        corpus = generate_corpus(args)
+        print(
+            f"Wrote {corpus['files']} files ({corpus['bytes'] / 1e6:.1f} MB) to "
+            f"{args.corpus_directory} in {time.perf_counter() - started:.1f} s",
+            file=sys.stderr,
+        )
+        return
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for line in compare(baseline, results):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+from collections import deque
+from concurrent.futures import Future
+
+from exif import Image
+
+from metadata_cache import cached_date_time
+from metadata_extractors import HEADER_BYTES, NO_DATE, extractor_for, read_date_time
+
+# Formats the exif library can parse, and so can fall back to when the headers could
+# not be read.
+EXIF_LIBRARY_FORMATS = ("jpeg", "tiff")
+
+
+def extract_date_time(filepath):
+    """Open a photo or video and read the date it was taken.
+
+    Returns a (filepath, opened, date_time, error) tuple so that it can run in a worker
+    process and leave the logging to the parent.
+    """
+    # Fast path: read only the metadata headers. Fall back to the exif library, which
+    # reads the whole file, only if the headers could not be parsed and the file is
+    # one it can read. Anything else, such as a video, would be read for nothing.
+    date_time = read_date_time(filepath)
+    if date_time == NO_DATE:
+        error = ValueError("No datetime_original found in EXIF data.")
+        return filepath, True, None, error
+    if date_time is not None:
+        return filepath, True, date_time, None
+
+    try:
+        with open(filepath, "rb") as img_file:
+            extractor = extractor_for(img_file.read(HEADER_BYTES))
+            if extractor is None or extractor.name not in EXIF_LIBRARY_FORMATS:
+                raise ValueError("Unreadable metadata.")
+            img_file.seek(0)
+            image = Image(img_file)
+    except Exception as e:
+        return filepath, False, None, e
+
+    try:
+        date_time = image.get("datetime_original")
+        if date_time is None:
+            raise ValueError("No datetime_original found in EXIF data.")
+    except Exception as e:
+        return filepath, True, None, e
+
+    return filepath, True, date_time, None
+
+
+def extract_all(image_files, cache, executor=None, window=256):
+    """Run extract_date_time over image_files, yielding results in input order.
+
+    Files with an up-to-date entry in the cache are not opened at all. The others are
+    submitted to executor, if one is given, keeping at most window files in flight so
+    that results start flowing before image_files has been exhausted.
+    """
+    in_flight = deque()
+    for f in image_files:
+        known, date_time = cached_date_time(cache.get(f)) if cache else (False, None)
+        if known:
+            error = None if date_time else ValueError("No datetime_original (cached).")
+            result = (f, True, date_time, error)
+        elif executor is None:
+            result = _cache_result(cache, extract_date_time(f))
+        else:
+            result = executor.submit(extract_date_time, f)
+
+        if executor is None:
+            yield result
+            continue
+        in_flight.append(result)
+        while len(in_flight) > window:
+            yield _resolve(cache, in_flight.popleft())
+
+    while in_flight:
+        yield _resolve(cache, in_flight.popleft())
+
+
+def _resolve(cache, result):
+    if isinstance(result, Future):
+        return _cache_result(cache, result.result())
+    return result
+
+
+def _cache_result(cache, result):
+    f, opened, date_time, _ = result
+    if cache and opened:
+        cache.put(f, date_time=date_time or "")
+    return result
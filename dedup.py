@@ -0,0 +1,235 @@
+import os
+import threading
+from stat import S_ISREG
+
+from file_hash import hash_file, quick_hash
+from metrics import NO_METRICS
+
+
+class DestinationIndex:
+    """In-memory index of the names of the files in the destination year directories.
+
+    Each directory is listed once, the first time it is used, and only the names are
+    kept. A source is compared with the files it would collide with, its name and
+    its numbered variants, as identical photos are taken in the same second. Only
+    those are stat'ed, and only those of the same size are hashed: a quick hash of
+    the size and first and last 64 KiB rules out most of them before the full hash
+    is computed. Full hashes of destination files are kept in the metadata cache, if
+    one is given, so they are not recomputed on later runs.
+
+    Paths handed out by allocate() are added to the index straight away, before the
+    file is written, so the index can be used to allocate names for files that are
+    still being copied by a worker. Directories are likewise only created once, by
+    ensure_directory(), so that on a network share a run needs one listing per
+    directory rather than several stats per file.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.names = {}  # directory -> set of file names
+        self.directories = set()  # directories known to exist
+        self.sizes = {}  # path -> size, for the files stat'ed so far
+        self.sources = {}  # destination path -> path to read its contents from
+        self.partial_hashes = {}
+        self.full_hashes = {}
+        # Held by callers that share the index between threads while they pick a name.
+        self.lock = threading.Lock()
+
+    def _load(self, directory):
+        if directory in self.names:
+            return
+        names = set()
+        self.names[directory] = names
+        try:
+            with os.scandir(directory) as entries:
+                names.update(entry.name for entry in entries)
+        except FileNotFoundError:
+            return
+        self.directories.add(directory)
+
+    def _forget(self, path):
+        self.sizes.pop(path, None)
+        self.partial_hashes.pop(path, None)
+        self.full_hashes.pop(path, None)
+
+    def _readable(self, path):
+        source = self.sources.get(path, path)
+        return source if os.path.exists(source) else path
+
+    def _size(self, path):
+        """Return the size of a destination file, or None if it is not a file."""
+        if path not in self.sizes:
+            try:
+                stat = os.stat(self._readable(path) if path in self.sources else path)
+            except OSError:
+                stat = None
+            regular = stat is not None and S_ISREG(stat.st_mode)
+            self.sizes[path] = stat.st_size if regular else None
+        return self.sizes[path]
+
+    def _colliding(self, directory, filename):
+        """Yield the paths of filename and its numbered variants in directory.
+
+        The variants are followed as allocate() hands them out, name_1, name_2, ...
+        up to the first that is missing.
+        """
+        names = self.names[directory]
+        stem, ext = os.path.splitext(filename)
+        candidate = filename
+        suffix = 0
+        while candidate in names:
+            yield os.path.join(directory, candidate)
+            suffix += 1
+            candidate = f"{stem}_{suffix}{ext}"
+
+    def _partial_hash(self, path):
+        if path not in self.partial_hashes:
+            self.partial_hashes[path] = quick_hash(self._readable(path))
+        return self.partial_hashes[path]
+
+    def _full_hash(self, path):
+        if path not in self.full_hashes:
+            readable = self._readable(path)
+            entry = self.cache.get(readable) if self.cache else None
+            if entry and entry["content_hash"]:
+                digest = entry["content_hash"]
+            else:
+                digest = hash_file(readable)
+                if self.cache:
+                    self.cache.put(readable, content_hash=digest)
+            self.full_hashes[path] = digest
+        return self.full_hashes[path]
+
+    def find_duplicate(self, filepath, directory, filename, content_hash=None):
+        """Return the path of a file with the same contents as filepath, or None.
+
+        The files looked at are filename and its numbered variants in directory.
+        """
+        self._load(directory)
+        size = None
+        partial = None
+        for candidate in self._colliding(directory, filename):
+            try:
+                if size is None:
+                    size = os.path.getsize(filepath)
+                if self._size(candidate) != size:
+                    continue
+                if partial is None:
+                    partial = quick_hash(filepath)
+                if self._partial_hash(candidate) != partial:
+                    continue
+                if content_hash is None:
+                    content_hash = hash_file(filepath)
+                if self._full_hash(candidate) == content_hash:
+                    return candidate
+            except OSError:
+                continue
+        return None
+
+    def allocate(self, directory, filename, source):
+        """Reserve a free name for source in directory.
+
+        If filename is taken, a numeric suffix is added: name_1.jpg, name_2.jpg, ...
+        """
+        self._load(directory)
+        names = self.names[directory]
+        stem, ext = os.path.splitext(filename)
+        candidate = filename
+        suffix = 0
+        while candidate in names:
+            suffix += 1
+            candidate = f"{stem}_{suffix}{ext}"
+        names.add(candidate)
+
+        path = os.path.join(directory, candidate)
+        self.sources[path] = source
+        return path
+
+    def ensure_directory(self, directory):
+        """Create directory unless it is known to exist. Returns whether it was created."""
+        self._load(directory)
+        if directory in self.directories:
+            return False
+        os.makedirs(directory, exist_ok=True)
+        self.directories.add(directory)
+        return True
+
+    def reserve(self, directory, filename):
+        """Mark filename in directory as taken, for a file whose contents are not indexed."""
+        self._load(directory)
+        self.names[directory].add(filename)
+        return os.path.join(directory, filename)
+
+    def exists(self, directory, filename):
+        """Return whether filename is in directory, or has been handed out already."""
+        self._load(directory)
+        return filename in self.names[directory]
+
+    def replace(self, directory, filename, source):
+        """Reserve filename in directory for source, replacing any file of that name."""
+        self._load(directory)
+        path = os.path.join(directory, filename)
+        self._forget(path)
+        self.names[directory].add(filename)
+        self.sources[path] = source
+        return path
+
+
+def plan_destination(
+    logger,
+    f,
+    date_time,
+    output_directory,
+    destinations,
+    force_overwrite=False,
+    skip_existing=False,
+    content_hash=None,
+    create_directories=True,
+    metrics=NO_METRICS,
+):
+    """Choose where to save f, based on its EXIF date.
+
+    Returns (new_filepath, duplicate). new_filepath is None if the file should not be
+    saved, either because it is identical to the existing file duplicate or because
+    its name is taken and skip_existing is set. Names are checked against the
+    destinations index rather than the disk, so paths that have been handed out but
+    not written yet count as taken.
+    """
+    if date_time:
+        year = date_time.split(":")[0]  # Extract the year from datetime_original
+    else:
+        logger.warning(f"Failed to find suitable EXIF data to rename for {f}.")
+        # If EXIF data is not found, move/copy the image to the "Other" directory
+        year = "Other"
+
+    # Create the year directory if it doesn't exist
+    year_directory = os.path.join(output_directory, year)
+    if create_directories:
+        with metrics.time("mkdir"):
+            if destinations.ensure_directory(year_directory):
+                logger.info(f"Created directory: {year_directory}")
+
+    try:
+        orig_ext = os.path.splitext(f)[-1]
+        new_filename = (
+            date_time.replace(":", "-").replace(" ", "_") + orig_ext
+            if date_time
+            else os.path.basename(f)
+        )
+    except Exception as e:
+        logger.warning(f"Failed to construct new filepath for {f}. Error: {e}")
+        return None, None
+
+    with metrics.time("collision_probe"):
+        if force_overwrite or skip_existing:
+            if skip_existing and destinations.exists(year_directory, new_filename):
+                return None, None
+            return destinations.replace(year_directory, new_filename, f), None
+
+        duplicate = destinations.find_duplicate(
+            f, year_directory, new_filename, content_hash
+        )
+        if duplicate:
+            logger.info(f"Skipping {f}: identical to {duplicate}.")
+            return None, duplicate
+        return destinations.allocate(year_directory, new_filename, f), None
@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+
+from file_transfer import sync_directory, sync_file, sync_filesystem
+
+JOURNAL_FILENAME = ".transfer_journal"
+
+# Number of sources whose outputs are made durable together.
+BATCH_SIZE = 256
+
+logger = logging.getLogger(__name__)
+
+
+def sync_paths(files=(), directories=()):
+    """Flush the given files and directories to disk. Raises OSError if that fails.
+
+    Where it can, each filesystem they are on is flushed with a single syncfs(),
+    which is much quicker than an fsync per file, each of which commits the
+    filesystem journal.
+    """
+    parents = set(directories) | {os.path.dirname(path) for path in files}
+    filesystems = {}
+    for directory in parents:
+        filesystems.setdefault(os.stat(directory).st_dev, directory)
+    if all(sync_filesystem(directory) for directory in filesystems.values()):
+        return
+    for path in files:
+        sync_file(path)
+    for directory in directories:
+        sync_directory(directory)
+
+
+class DurableBatch:
+    """Makes copies, moves and other writes crash-safe without an fsync per file.
+
+    Outputs are written under temporary names from temp_path() and handed over with
+    add(). Every BATCH_SIZE sources, the batch is committed: the temporary files are
+    flushed to disk, renamed to their final names, their directories are flushed,
+    and only then are the sources that were moved deleted. A crash therefore leaves
+    either a complete output or none, and never loses a source. If a flush fails,
+    commit() raises OSError and deletes nothing; the next run rolls the batch back
+    or finishes it from the journal.
+
+    Each step is recorded in a journal. If a run is interrupted, the next one to
+    open the journal finishes any batch that was being committed and deletes the
+    temporary files of batches that were not.
+
+    on_commit(source, destinations, tag) is called for every source once its outputs
+    are durable.
+    """
+
+    def __init__(self, directory, batch_size=BATCH_SIZE, on_commit=None):
+        self.path = os.path.join(directory, JOURNAL_FILENAME)
+        self.batch_size = batch_size
+        self.on_commit = on_commit
+        recover(self.path)
+        self.batch_id = 1
+        self.entries = []
+        self.staged = 0
+        # Temporary files handed out and not committed yet.
+        self.temps = set()
+        self.journal = open(self.path, "w")
+
+    def _log(self, record, sync=False):
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+        if sync:
+            os.fsync(self.journal.fileno())
+
+    def temp_path(self, path):
+        """Return a temporary name to write path under until the batch is committed."""
+        self.staged += 1
+        temp = f"{path}.{self.staged}.part"
+        self._log({"batch": self.batch_id, "op": "stage", "temp": temp})
+        self.temps.add(temp)
+        return temp
+
+    def add(self, outputs, source=None, delete_source=False, tag=None):
+        """Hand over the outputs of source as a list of (temp, destination) pairs.
+
+        A temp of None means the destination is already in place, for example
+        because source was renamed to it; its directory is still flushed on commit.
+        With delete_source, source is deleted once its outputs are durable.
+        """
+        entry = {
+            "source": source,
+            "outputs": outputs,
+            "delete_source": delete_source,
+        }
+        self._log({"batch": self.batch_id, "op": "add", **entry})
+        self.entries.append((entry, tag))
+        if len(self.entries) >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if not self.entries:
+            return
+        entries = [entry for entry, _ in self.entries]
+        temps = [temp for entry in entries for temp, _ in entry["outputs"] if temp]
+        try:
+            sync_paths(files=temps)
+            self._log({"batch": self.batch_id, "op": "commit"}, sync=True)
+            _finish(entries)
+        except OSError as e:
+            logger.error(
+                f"Could not commit batch {self.batch_id}, so no source was deleted. "
+                f"Error: {e}"
+            )
+            raise
+        self._log({"batch": self.batch_id, "op": "done"})
+        self.temps.difference_update(temps)
+
+        for entry, tag in self.entries:
+            if self.on_commit:
+                destinations = [destination for _, destination in entry["outputs"]]
+                self.on_commit(entry["source"], destinations, tag)
+        self.entries = []
+        self.batch_id += 1
+
+    def close(self):
+        self.commit()
+        # Whatever is left was written by a transfer that failed.
+        _remove_existing(self.temps)
+        self.journal.close()
+        # Every batch is done, so there is nothing left to recover.
+        os.remove(self.path)
+
+
+def _finish(entries):
+    """Rename the flushed temporary files into place and delete moved sources."""
+    directories = set()
+    for entry in entries:
+        for temp, destination in entry["outputs"]:
+            if temp and os.path.exists(temp):
+                os.replace(temp, destination)
+            directories.add(os.path.dirname(destination))
+        if entry["source"] and entry["outputs"] and entry["outputs"][0][0] is None:
+            directories.add(os.path.dirname(entry["source"]))
+    sync_paths(directories=directories)
+
+    for entry in entries:
+        if not entry["delete_source"]:
+            continue
+        if all(os.path.exists(destination) for _, destination in entry["outputs"]):
+            _remove_existing([entry["source"]])
+
+
+def recover(path):
+    """Complete or roll back the batches of an interrupted run, then clear the journal."""
+    try:
+        with open(path) as journal:
+            lines = journal.readlines()
+    except FileNotFoundError:
+        return
+
+    batches = {}
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break  # The last line may have been cut short by the crash.
+        batches.setdefault(record["batch"], []).append(record)
+
+    for _, records in sorted(batches.items()):
+        ops = {record["op"] for record in records}
+        if "commit" in ops and "done" not in ops:
+            # The outputs were flushed before the commit was recorded.
+            entries = [record for record in records if record["op"] == "add"]
+            _finish(entries)
+            logger.info(f"Recovered {len(entries)} files from an interrupted run.")
+
+    # Anything not renamed by now was never committed. Its source is still there.
+    temps = [
+        record["temp"]
+        for records in batches.values()
+        for record in records
+        if record["op"] == "stage"
+    ]
+    _remove_existing(temps)
+    os.remove(path)
+
+
+def _remove_existing(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,15 +1,137 @@
 import argparse
 import os
+import shutil
+import struct
 import sys
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 from exif import Image
-from pathlib import Path
-import re
+
+from date_extraction import extract_all
+from exif_reader import (EXIF_HEADER, JPEG_EOI, JPEG_SOI, datetime_original_offset,
+                         locate_jpeg_exif, parse_datetime_original)
+from file_scanner import scan_files
+from file_transfer import copy_stream
+from metadata_cache import MetadataCache
+from metrics import Metrics, add_arguments, file_logger, finish_run
 
 img_formats = ['.png', '.jpg', '.jpeg']
 
-def is_image_file(filepath):
-    return os.path.splitext(filepath)[-1].lower() in img_formats
+SECONDS_PER_DAY = 3600 * 24
+
+# Keys for the order in which files are given their timestamps.
+order_keys = {
+    'name': lambda filepath: (os.path.basename(filepath), filepath),
+    'path': lambda filepath: filepath,
+    'mtime': lambda filepath: (os.stat(filepath).st_mtime_ns, filepath),
+}
+
+def replace_bytes(filepath, start, end, data):
+    """Replace bytes start to end of a file with data, copying the rest unchanged.
+
+    The new file is written next to the original and renamed over it, so an
+    interruption leaves one or the other.
+    """
+    temp = filepath + '.part'
+    with open(filepath, 'rb') as src, open(temp, 'wb') as dst:
+        dst.write(src.read(start))
+        dst.write(data)
+        copy_stream(src, dst, end)
+    shutil.copymode(filepath, temp)
+    os.replace(temp, filepath)
+
+def stamp_jpeg(filepath, date_time, overwrite):
+    """Set the DateTimeOriginal of a JPEG, touching only its EXIF segment.
+
+    An existing date of the same length is overwritten in place with one pwrite.
+    Otherwise only the EXIF segment is rebuilt and the image data is copied as is.
+    Returns (result, existing): result is 'skipped' if the file has a date and
+    overwrite is not set, 'patched', 'rewritten', or None if the file is not a JPEG
+    this can handle. existing is the date the file had, if any.
+    """
+    with open(filepath, 'rb') as img_file:
+        span = locate_jpeg_exif(img_file)
+        if span is None:
+            return None, None
+        start, end = span
+        img_file.seek(start)
+        segment = img_file.read(end - start)
+
+    # The TIFF block follows the marker, the length and the Exif header.
+    tiff_start = 4 + len(EXIF_HEADER)
+    tiff = segment[tiff_start:]
+    try:
+        slot = datetime_original_offset(tiff) if tiff else None
+        existing = parse_datetime_original(tiff) if slot else None
+    except (struct.error, IndexError, UnicodeDecodeError):
+        slot, existing = None, None
+    if existing and not overwrite:
+        return 'skipped', existing
+
+    value = date_time.encode('ascii') + b'\x00'
+    if slot and slot[1] == len(value):
+        fd = os.open(filepath, os.O_WRONLY)
+        try:
+            os.pwrite(fd, value, start + tiff_start + slot[0])
+        finally:
+            os.close(fd)
+        return 'patched', existing
+
+    # Let the exif library rebuild just the segment, wrapped in an otherwise empty JPEG.
+    image = Image(JPEG_SOI + segment + JPEG_EOI)
+    if segment and not existing:
+        try:
+            existing = image.get('datetime_original')
+        except:
+            existing = None
+        if existing and not overwrite:
+            return 'skipped', existing
+    image.datetime_original = date_time
+    replace_bytes(filepath, start, end, image.get_file()[2:-2])
+    return 'rewritten', existing
+
+def stamp_file(filepath, date_time, overwrite):
+    """Set the DateTimeOriginal of any image the exif library can read.
+
+    Slower than stamp_jpeg, as the whole file is read and written again.
+    """
+    with open(filepath, 'rb') as img_file:
+        image = Image(img_file)
+    try:
+        existing = image.get('datetime_original')
+    except:
+        existing = None
+    if existing and not overwrite:
+        return 'skipped', existing
+    image.datetime_original = date_time
+    replace_bytes(filepath, 0, os.path.getsize(filepath), image.get_file())
+    return 'rewritten', existing
+
+def stamp(filepath, date_time, overwrite):
+    """Set the DateTimeOriginal of a file, by the fastest means that works for it.
+
+    Returns a (filepath, date_time, result, existing, error) tuple, so that it can
+    run in a worker process and leave the logging and caching to the parent.
+    """
+    try:
+        result, existing = stamp_jpeg(filepath, date_time, overwrite)
+        if result is None:
+            result, existing = stamp_file(filepath, date_time, overwrite)
+    except Exception as e:
+        return filepath, date_time, None, None, e
+    return filepath, date_time, result, existing, None
+
+def assign_date_times(files, date, multi_day):
+    """Pair each file with a timestamp, one second apart from midnight on date.
+
+    Without multi_day, files that do not fit in the day are left out.
+    """
+    start = datetime.strptime(date, '%Y:%m:%d')
+    if not multi_day:
+        files = files[:SECONDS_PER_DAY]
+    return [(f, (start + timedelta(seconds=i)).strftime('%Y:%m:%d %H:%M:%S'))
+            for i, f in enumerate(files)]
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -21,7 +143,18 @@ def parse_args():
                         help='Force overwrite of existing datetime string.')
     parser.add_argument('--date', '-d', dest='date', type=str, required=True,
                         help='Date to add. Note that timestamps will be incremented. Format: YYYY:MM:DD')
-                        
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help='Do not read or update the metadata cache kept in the input directory.')
+    parser.add_argument('--order', dest='order', choices=sorted(order_keys), default='name',
+                        help='Order in which files are given increasing timestamps: by file name, '
+                             'by full path, or by modification time. Defaults to name.')
+    parser.add_argument('--multi-day', dest='multi_day', action='store_true',
+                        help='Carry on into the following days if there are more than 86400 images, '
+                             'instead of stopping when the day is full.')
+    parser.add_argument('--workers', '-w', dest='workers', type=int, default=1,
+                        help='Number of worker processes used to read and write EXIF data.')
+    add_arguments(parser)
+
     return parser.parse_args()
 
 def main():
@@ -33,10 +166,14 @@ def main():
                         level=logging.INFO)
 
     logger = logging.getLogger(__name__)
+    # Messages about individual files, which can be limited with --file-log-rate.
+    flogger = file_logger(logger, args.file_log_rate)
 
-    if not re.match('\d{4}:\d{2}:\d{2}', args.date):
+    try:
+        datetime.strptime(args.date, '%Y:%m:%d')
+    except ValueError:
         logger.critical(f"Date format incorrect. See --help options.")
-        sys.exit()        
+        sys.exit()
 
     image_dir = os.path.abspath(args.input_directory)
     args.input_directory = image_dir
@@ -48,49 +185,73 @@ def main():
 
     logger.info(f"Searching for images in {image_dir}...")
 
-    if args.recursive:
-        files = list(Path(image_dir).rglob("*"))
-    else:
-        files = list(Path(image_dir).glob("*"))
-
-    image_files = list(filter(is_image_file, files))
+    image_files = sorted(scan_files(image_dir, img_formats, args.recursive),
+                         key=order_keys[args.order])
     num_files = len(image_files)
+    metrics = Metrics('exif_date_adder', logger, total=num_files,
+                      interval=args.progress_interval)
 
-    logger.info(f"Found {num_files} files. Processing...")
+    cache = MetadataCache.in_directory(image_dir) if args.use_cache else None
 
-    converted_count = 0 
-    for f in image_files:
-        logger.info(f"Opening image: {f}...")
-        try:
-            with open(f, 'rb') as img_file:
-                image = Image(img_file)
-        except Exception as e:
-            logger.warning(f"Failed to open file {f}")
-            logger.debug(e)
-            continue
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
 
-        hours = converted_count // 3600
-        minutes = (converted_count % 3600) // 60
-        seconds  = (converted_count % 3600) % 60
-
-        try:
-            image.get("datetime_original")
-            if not args.overwrite:
-                logger.info("File already has EXIF date time stamp. Skipping.")
+    # Find the files that need a date first, so that each one's timestamp is known
+    # before any is written. The result then depends only on the order, not on
+    # which worker finishes first.
+    if args.overwrite:
+        targets = image_files
+    else:
+        targets = []
+        extracted = extract_all(image_files, cache, executor)
+        for f, opened, date_time, error in metrics.timed('extract', extracted):
+            if not opened:
+                flogger.warning(f"Failed to open file {f}")
+                logger.debug(error)
+                metrics.count('failed_open')
+            elif date_time:
+                flogger.info(f"File {f} already has EXIF date time stamp. Skipping.")
+                metrics.count('skipped')
+            else:
+                targets.append(f)
                 continue
-        except:
-            pass
+            metrics.file_done()
+
+    jobs = assign_date_times(targets, args.date, args.multi_day)
+    if len(jobs) < len(targets):
+        logger.warning("Maximum number of images reached for this day.")
+
+    if executor is None:
+        results = (stamp(f, date_time, args.overwrite) for f, date_time in jobs)
+    else:
+        results = executor.map(stamp, *zip(*jobs), [args.overwrite] * len(jobs),
+                               chunksize=16)
 
-        image.datetime_original = f"{args.date} {hours:02d}:{minutes:02d}:{seconds:02d}"
+    converted_count = 0
+    for f, new_date_time, result, date_time, error in metrics.timed('stamp', results):
+        metrics.file_done()
+        metrics.count(result or 'failed')
+        if result is None:
+            flogger.warning(f"Failed to update file {f}")
+            logger.debug(error)
+            continue
 
-        with open(f, 'wb') as img_file:
-            img_file.write(image.get_file())
+        if result == 'skipped':
+            if cache:
+                cache.put(f, date_time=date_time)
+            flogger.info(f"File {f} already has EXIF date time stamp. Skipping.")
+            continue
 
+        flogger.info(f"{result.capitalize()} EXIF date of {f} to {new_date_time}.")
+        if cache:
+            cache.put(f, date_time=new_date_time)
         converted_count += 1
-        if converted_count == (3600 * 24):
-            logger.warning("Maximum number of images reached for this day.")
-            break
 
+    if executor is not None:
+        executor.shutdown()
+    if cache:
+        cache.close()
+
+    finish_run(logger, args, metrics)
     logger.info(f"Jobs completed. Updated EXIF date {converted_count} of {num_files} files")
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+import struct
+
+# Only the metadata at the start of the file is read. The EXIF APP1 segment is
+# limited to 64 KiB by the JPEG format, so this is plenty for any real camera file.
+MAX_HEADER_BYTES = 256 * 1024
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+EXIF_HEADER = b"Exif\x00\x00"
+
+TAG_EXIF_IFD_POINTER = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TYPE_ASCII = 2
+
+
+def read_exif_block(img_file, max_bytes=MAX_HEADER_BYTES):
+    """Return the raw TIFF-structured EXIF block of an open JPEG or PNG file.
+
+    Returns b"" if the file certainly has no EXIF block, because the image data was
+    reached without finding one, and None if that could not be determined.
+    """
+    signature = img_file.read(8)
+    if signature.startswith(JPEG_SOI):
+        img_file.seek(2)
+        return _read_jpeg_app1(img_file, max_bytes)
+    if signature == PNG_SIGNATURE:
+        return _read_png_exif(img_file, max_bytes)
+    return None
+
+
+def _read_jpeg_app1(img_file, max_bytes):
+    while img_file.tell() < max_bytes:
+        marker = img_file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        # Start of scan or end of image: the metadata segments are over.
+        if marker[1] in (0xDA, 0xD9):
+            return b""
+        length_bytes = img_file.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0] - 2
+        if marker[1] == 0xE1:
+            segment = img_file.read(length)
+            if len(segment) < length:
+                return None
+            if segment.startswith(EXIF_HEADER):
+                return segment[len(EXIF_HEADER) :]
+        else:
+            img_file.seek(length, 1)
+    return None
+
+
+def locate_jpeg_exif(img_file, max_bytes=MAX_HEADER_BYTES):
+    """Find the EXIF APP1 segment of an open JPEG file.
+
+    Returns the (start, end) file offsets of the segment, marker included, so that
+    it can be replaced without touching the rest of the file. If there is no EXIF
+    segment, start and end are both where one should be inserted: after SOI and any
+    JFIF APP0 segment. Returns None if the file is not a JPEG or the segments before
+    the image data could not be read.
+    """
+    img_file.seek(0)
+    if img_file.read(2) != JPEG_SOI:
+        return None
+    insert_at = 2
+    while img_file.tell() < max_bytes:
+        start = img_file.tell()
+        marker = img_file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] in (0xDA, 0xD9):
+            return insert_at, insert_at
+        length_bytes = img_file.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0] - 2
+        if marker[1] == 0xE1 and img_file.read(len(EXIF_HEADER)) == EXIF_HEADER:
+            return start, start + 4 + length
+        if marker[1] == 0xE0 and start == 2:
+            insert_at = start + 4 + length
+        img_file.seek(start + 4 + length)
+    return None
+
+
+def _read_png_exif(img_file, max_bytes):
+    while img_file.tell() < max_bytes:
+        header = img_file.read(8)
+        if len(header) < 8:
+            return None
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"eXIf":
+            data = img_file.read(length)
+            if len(data) < length:
+                return None
+            # Some writers keep the JPEG style prefix in the chunk.
+            if data.startswith(EXIF_HEADER):
+                data = data[len(EXIF_HEADER) :]
+            return data
+        if chunk_type in (b"IDAT", b"IEND"):
+            return b""
+        img_file.seek(length + 4, 1)  # Chunk data plus CRC.
+    return None
+
+
+def _find_ifd_entry(tiff, endian, ifd_offset, wanted_tag):
+    (num_entries,) = struct.unpack_from(endian + "H", tiff, ifd_offset)
+    for i in range(num_entries):
+        entry_offset = ifd_offset + 2 + i * 12
+        tag, field_type, count = struct.unpack_from(endian + "HHI", tiff, entry_offset)
+        if tag == wanted_tag:
+            return field_type, count, entry_offset + 8
+    return None
+
+
+def datetime_original_offset(tiff):
+    """Return (offset, count) of the DateTimeOriginal value in a TIFF block, or None.
+
+    count is the length of the field, including its terminating NUL. Raises
+    struct.error or IndexError if the block is cut short before the value ends.
+    """
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return None
+    (ifd0_offset,) = struct.unpack_from(endian + "I", tiff, 4)
+
+    entry = _find_ifd_entry(tiff, endian, ifd0_offset, TAG_EXIF_IFD_POINTER)
+    if entry is None:
+        return None
+    (exif_ifd_offset,) = struct.unpack_from(endian + "I", tiff, entry[2])
+
+    entry = _find_ifd_entry(tiff, endian, exif_ifd_offset, TAG_DATETIME_ORIGINAL)
+    if entry is None:
+        return None
+    field_type, count, value_offset = entry
+    if field_type != TYPE_ASCII:
+        return None
+    if count > 4:
+        (value_offset,) = struct.unpack_from(endian + "I", tiff, value_offset)
+    if value_offset + count > len(tiff):
+        raise IndexError("DateTimeOriginal cut short")
+    return value_offset, count
+
+
+def parse_datetime_original(tiff):
+    """Return DateTimeOriginal from a TIFF-structured EXIF block, or None."""
+    slot = datetime_original_offset(tiff)
+    if slot is None:
+        return None
+    value_offset, count = slot
+    value = tiff[value_offset : value_offset + count]
+    date_time = value.rstrip(b"\x00 ").decode("ascii")
+    return date_time or None
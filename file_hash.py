@@ -0,0 +1,134 @@
+import hashlib
+import mmap
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:  # Optional; only makes the fast digest faster and wider.
+    xxhash = None
+
+# SHA-256 is what manifests, ledgers and the metadata cache store. "fast" is a
+# non-cryptographic digest for comparisons within a run, such as prefiltering.
+ALGORITHMS = ["sha256", "fast"]
+
+# Files at least this big are hashed through mmap, without copying them into Python.
+MMAP_THRESHOLD = 1024 * 1024
+
+# Bytes per read when a file cannot be mapped, a multiple of the page size.
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Bytes read from each end of a file by quick_hash().
+QUICK_HASH_BYTES = 64 * 1024
+
+# Hashing and reading both release the GIL, so threads hash several files at once.
+DEFAULT_WORKERS = 4
+
+# Files queued for each hashing thread. hash_files() reads no further ahead in its
+# input, so that can be a generator of any length.
+QUEUED_PER_WORKER = 4
+
+
+class _Checksum:
+    """CRC-32 and Adler-32 side by side: a 64-bit fast digest without xxhash."""
+
+    def __init__(self):
+        self.crc = 0
+        self.adler = 1
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.adler = zlib.adler32(data, self.adler)
+
+    def hexdigest(self):
+        return f"{self.crc:08x}{self.adler:08x}"
+
+
+def new_digest(algorithm="sha256"):
+    if algorithm == "sha256":
+        return hashlib.sha256()
+    if algorithm == "fast":
+        return xxhash.xxh3_128() if xxhash else _Checksum()
+    raise ValueError(f"Unknown hash algorithm: {algorithm}")
+
+
+def hash_file(filepath, algorithm="sha256"):
+    """Return the hex digest of a file's contents, SHA-256 unless algorithm is "fast"."""
+    digest = new_digest(algorithm)
+    with open(filepath, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD or not _hash_mapped(f, digest):
+            _hash_stream(f, digest)
+    return digest.hexdigest()
+
+
+def _hash_mapped(f, digest):
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False  # Some network and FUSE filesystems cannot be mapped.
+    with mapped:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            digest.update(view)
+    return True
+
+
+def _hash_stream(f, digest):
+    buffer = bytearray(READ_CHUNK_SIZE)
+    with memoryview(buffer) as view:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+
+
+def quick_hash(filepath, num_bytes=QUICK_HASH_BYTES):
+    """Return a fast digest of a file's size and its first and last num_bytes.
+
+    Files that differ in this hash are certainly different; files that match it
+    still need a full hash to be sure they are the same.
+    """
+    digest = new_digest("fast")
+    with open(filepath, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        digest.update(size.to_bytes(8, "little"))
+        digest.update(f.read(num_bytes))
+        if size > num_bytes:
+            f.seek(max(num_bytes, size - num_bytes))
+            digest.update(f.read(num_bytes))
+    return digest.hexdigest()
+
+
+def hash_files(filepaths, algorithm="sha256", workers=DEFAULT_WORKERS, quick=False):
+    """Hash files on a thread pool, so that reading one overlaps hashing another.
+
+    Yields (filepath, hex digest, error) in the order of filepaths, with a digest
+    of None and the exception if a file could not be read. With quick, files are
+    hashed with quick_hash() instead. filepaths is read QUEUED_PER_WORKER files
+    per thread ahead of the results.
+    """
+
+    def hash_one(filepath):
+        try:
+            if quick:
+                return filepath, quick_hash(filepath), None
+            return filepath, hash_file(filepath, algorithm), None
+        except OSError as e:
+            return filepath, None, e
+
+    if workers <= 1:
+        yield from map(hash_one, filepaths)
+        return
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filepath in filepaths:
+            in_flight.append(executor.submit(hash_one, filepath))
+            if len(in_flight) >= workers * QUEUED_PER_WORKER:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
@@ -0,0 +1,53 @@
+import os
+
+# Files of a directory sorted together by inode, so that a directory of any size is
+# still read lazily.
+INODE_WINDOW = 256
+
+
+def scan_files(directory, extensions, recursive=False, exclude=(), by_inode=False):
+    """Yield the paths of files in directory with one of the given extensions.
+
+    Directories are read lazily with os.scandir, one at a time, so the first file is
+    yielded straight away and memory use does not grow with the size of the tree.
+    The extension is checked on the name alone before the entry type, which scandir
+    usually knows without an extra stat. Directories in exclude are not entered.
+    With by_inode, the files of each directory are yielded in inode order, which on
+    most filesystems is close to the order of their data on disk, INODE_WINDOW
+    files at a time.
+    """
+    extensions = {extension.lower() for extension in extensions}
+    exclude = {os.path.abspath(path) for path in exclude}
+    pending = [os.path.abspath(directory)]
+    while pending:
+        current = pending.pop()
+        try:
+            entries = os.scandir(current)
+        except OSError:
+            continue
+        subdirectories = []
+        files = []
+        with entries:
+            for entry in entries:
+                try:
+                    if os.path.splitext(entry.name)[1].lower() in extensions:
+                        if entry.is_file():
+                            if by_inode:
+                                files.append((entry.inode(), entry.path))
+                                if len(files) >= INODE_WINDOW:
+                                    files.sort()
+                                    yield from (path for _, path in files)
+                                    files.clear()
+                            else:
+                                yield entry.path
+                            continue
+                    if recursive and entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                except OSError:
+                    continue
+        files.sort()
+        yield from (path for _, path in files)
+        # Reversed so that subdirectories are visited in the order they were listed.
+        for subdirectory in reversed(subdirectories):
+            if subdirectory not in exclude:
+                pending.append(subdirectory)
@@ -0,0 +1,204 @@
+import ctypes
+import errno
+import os
+import shutil
+import sys
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ioctl that makes dst share src's blocks on copy-on-write filesystems (btrfs, XFS).
+FICLONE = 0x40049409
+
+# Bytes per copy_file_range or sendfile call.
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def _load_syncfs():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+
+# Flushes one filesystem, where the C library has it (Linux).
+_syncfs = _load_syncfs()
+
+
+def copy_file(src, dst, hardlink=False, sync=False):
+    """Copy the contents of src to dst, replacing dst if it exists.
+
+    With hardlink, dst is made a hard link to src when they are on the same
+    filesystem; the two names then share one file, so editing one changes both.
+    Otherwise the copy is a reflink where the filesystem supports it, which shares
+    blocks until either file is modified, and is done in the kernel with
+    copy_file_range or sendfile where it does not. Plain read/write is the last
+    resort. With sync, dst is flushed to disk before returning.
+    """
+    try:
+        if os.path.samefile(src, dst):
+            raise shutil.SameFileError(f"{src} and {dst} are the same file")
+        # Remove dst rather than writing into it, in case it is hard linked to
+        # another file that should keep its contents.
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass  # Different filesystem; copy instead.
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if not _clone(fsrc, fdst):
+            copy_stream(fsrc, fdst)
+        if sync:
+            fdst.flush()
+            os.fsync(fdst.fileno())
+
+
+def move_file(src, dst):
+    """Move src to dst, replacing dst if it exists.
+
+    os.rename cannot move between filesystems, such as from a phone mount to an
+    external drive. In that case src is copied, the copy is flushed to disk and
+    only then is src deleted.
+    """
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    copy_file(src, dst, sync=True)
+    shutil.copystat(src, dst)
+    # The new directory entry must be on disk too, or a crash could lose both.
+    sync_directory(os.path.dirname(os.path.abspath(dst)))
+    os.unlink(src)
+
+
+def sync_directory(directory):
+    """Flush a directory's entries to disk, so that files created in it survive a crash."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # Directories cannot be opened on Windows, which needs no flush.
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        # Some network and FUSE filesystems cannot flush a directory on its own.
+        if e.errno not in (errno.EINVAL, errno.ENOTSUP):
+            raise
+    finally:
+        os.close(fd)
+
+
+def sync_file(path):
+    """Flush a file's contents to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_filesystem(directory):
+    """Flush everything written to the filesystem holding directory.
+
+    Returns False, having done nothing, where that cannot be done in one call.
+    """
+    if _syncfs is None:
+        return False
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), directory)
+    finally:
+        os.close(fd)
+    return True
+
+
+def transfer_file(src, dst, delete_originals, hardlink=False, temp=None):
+    """Move or copy src to dst.
+
+    With temp, the copy is written to temp instead, to be renamed to dst when its
+    DurableBatch is committed, and a move across filesystems leaves src in place to
+    be deleted then. Returns (src, dst, staged), where staged is the path actually
+    written, or None if the file went straight to dst.
+    """
+    if temp is None:
+        if delete_originals:
+            move_file(src, dst)
+        else:
+            copy_file(src, dst, hardlink=hardlink)
+        return src, dst, None
+
+    if delete_originals:
+        try:
+            # A rename is atomic, so it can go straight to dst.
+            os.rename(src, dst)
+            return src, dst, None
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    copy_file(src, temp, hardlink=hardlink)
+    if delete_originals:
+        shutil.copystat(src, temp)
+    return src, dst, temp
+
+
+def _clone(fsrc, fdst):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def copy_stream(fsrc, fdst, offset=0):
+    """Copy fsrc from offset to its end onto the end of what has been written to fdst.
+
+    Both are open binary files. The data is copied within the kernel where possible.
+    """
+    fdst.flush()
+    src_pos = offset
+    dst_pos = fdst.tell()
+    # copy_file_range copies within the kernel, and on NFS and some other
+    # filesystems without the data crossing the network at all.
+    if hasattr(os, "copy_file_range"):
+        try:
+            while True:
+                n = os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), COPY_CHUNK_SIZE, src_pos, dst_pos
+                )
+                if n == 0:
+                    fdst.seek(dst_pos)
+                    return
+                src_pos += n
+                dst_pos += n
+        except OSError:
+            pass  # Not supported between these filesystems; carry on below.
+
+    fdst.seek(dst_pos)
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        try:
+            while True:
+                n = os.sendfile(fdst.fileno(), fsrc.fileno(), src_pos, COPY_CHUNK_SIZE)
+                if n == 0:
+                    return
+                src_pos += n
+                dst_pos += n
+        except OSError:
+            fdst.seek(dst_pos)
+
+    fsrc.seek(src_pos)
+    shutil.copyfileobj(fsrc, fdst)
@@ -1,16 +1,27 @@
+import argparse
 import json
 import os
-import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import requests
+from requests.adapters import HTTPAdapter
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
+from photos_api import get_with_retry
+
 # If modifying these SCOPES, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/photoslibrary"]
 
+DEFAULT_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Ids of completed downloads, one per line, kept in the download directory.
+JOURNAL_FILENAME = ".download_journal"
+
 
 def authenticate():
     """Authenticate the user and return the credentials."""
@@ -68,7 +79,7 @@ def list_media_items(session, start_date, end_date):
             payload_dict["pageToken"] = next_page_token
             payload = json.dumps(payload_dict)
 
-        response = requests.post(url, headers=headers, data=payload)
+        response = session.post(url, headers=headers, data=payload)
         if response.status_code != 200:
             print(f"Failed to list media items: {response.content}")
             break
@@ -83,19 +94,80 @@ def list_media_items(session, start_date, end_date):
 
 
 def download_photo(session, media_item, download_dir):
-    """Download a photo."""
+    """Download a photo, streaming it to disk. Returns its filename, or None on failure."""
     base_url = media_item["baseUrl"]
     filename = os.path.join(download_dir, f"{media_item['id']}.jpg")
-    response = requests.get(f"{base_url}=d")
-    if response.status_code == 200:
-        with open(filename, "wb") as file:
-            file.write(response.content)
-        print(f"Downloaded {filename}")
-    else:
-        print(f"Failed to download {filename}: {response.content}")
-
-
-def main(start_date_str, end_date_str, download_dir):
+    partial_filename = filename + ".part"
+    with get_with_retry(session, f"{base_url}=d", stream=True) as response:
+        if response.status_code != 200:
+            print(f"Failed to download {filename}: {response.content}")
+            return None
+        with open(partial_filename, "wb") as file:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+    # Only complete files get their final name, so an interrupted download is redone.
+    os.replace(partial_filename, filename)
+    print(f"Downloaded {filename}")
+    return filename
+
+
+def read_journal(download_dir):
+    """Return the ids of media items that were already downloaded to download_dir."""
+    journal_path = os.path.join(download_dir, JOURNAL_FILENAME)
+    if not os.path.exists(journal_path):
+        return set()
+    with open(journal_path) as journal:
+        return {line.strip() for line in journal if line.strip()}
+
+
+def download_all(
+    session, media_items, download_dir, workers=DEFAULT_WORKERS, on_downloaded=None
+):
+    """Download media items concurrently, skipping those recorded in the journal.
+
+    Each completed download is appended to the journal in download_dir, so that an
+    interrupted run continues where it stopped, and its filename is passed to
+    on_downloaded if given. Downloads are handed on in the order of media_items,
+    whichever finishes first, so that what is done with them does not depend on
+    timing. Returns the number of failures.
+    """
+    done = read_journal(download_dir)
+    remaining = [item for item in media_items if item["id"] not in done]
+    if len(remaining) < len(media_items):
+        print(f"Skipping {len(media_items) - len(remaining)} already downloaded items")
+
+    # One pooled connection per worker thread.
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    journal_lock = threading.Lock()
+    failed = 0
+    with open(os.path.join(download_dir, JOURNAL_FILENAME), "a") as journal:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(download_photo, session, item, download_dir): item
+                for item in remaining
+            }
+            for future in futures:
+                item = futures[future]
+                try:
+                    filename = future.result()
+                except Exception as e:
+                    print(f"Error downloading {item['id']}: {e}")
+                    filename = None
+                if not filename:
+                    failed += 1
+                    continue
+                with journal_lock:
+                    journal.write(f"{item['id']}\n")
+                    journal.flush()
+                if on_downloaded:
+                    on_downloaded(filename)
+    return failed
+
+
+def main(start_date_str, end_date_str, download_dir, workers=DEFAULT_WORKERS):
     start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
     end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
 
@@ -111,13 +183,24 @@ def main(start_date_str, end_date_str, download_dir):
         f"Found {len(media_items)} media items between {start_date_str} and {end_date_str}"
     )
 
-    for media_item in media_items:
-        download_photo(session, media_item, download_dir)
+    failed = download_all(session, media_items, download_dir, workers)
+    if failed:
+        print(f"{failed} downloads failed. Run again to retry them.")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python download_photos.py <start_date> <end_date> <download_dir>")
-        print("Dates should be in YYYY-MM-DD format")
-    else:
-        main(sys.argv[1], sys.argv[2], sys.argv[3])
+    parser = argparse.ArgumentParser(
+        description="Download photos from Google Photos between two dates."
+    )
+    parser.add_argument("start_date", help="Start date in YYYY-MM-DD format.")
+    parser.add_argument("end_date", help="End date in YYYY-MM-DD format.")
+    parser.add_argument("download_dir", help="Directory to save the photos in.")
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of concurrent downloads.",
+    )
+    args = parser.parse_args()
+    main(args.start_date, args.end_date, args.download_dir, args.workers)
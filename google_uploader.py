@@ -1,15 +1,27 @@
+import argparse
 import json
 import os
-import sys
 
 import requests
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
+from file_scanner import scan_files
+from metadata_extractors import media_extensions
+from photos_api import DEFAULT_UPLOAD_WORKERS, list_all_media_items, upload_all
+from upload_ledger import UploadLedger
+
 # If modifying these SCOPES, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/photoslibrary"]
 
+img_formats = media_extensions()
+
+UPLOAD_ROUNDS = 3
+
+# Files that could not be uploaded, with the reason, for --retry-failed.
+RETRY_QUEUE_FILENAME = "failed_uploads.json"
+
 
 def authenticate():
     """Authenticate the user and return the credentials."""
@@ -27,94 +39,106 @@ def authenticate():
     return creds
 
 
-def sanitize_filename(filename):
-    """Sanitize filename to ensure it contains only ASCII characters."""
-    return filename.encode("ascii", errors="ignore").decode("ascii")
-
+def read_retry_queue():
+    if not os.path.exists(RETRY_QUEUE_FILENAME):
+        return []
+    with open(RETRY_QUEUE_FILENAME) as f:
+        return [entry["path"] for entry in json.load(f)]
 
-def upload_photo(session, file_path):
-    """Upload a photo to Google Photos."""
-    upload_url = "https://photoslibrary.googleapis.com/v1/uploads"
-    sanitized_filename = sanitize_filename(os.path.basename(file_path))
-    headers = {
-        "Authorization": f"Bearer {session.credentials.token}",
-        "Content-type": "application/octet-stream",
-        "X-Goog-Upload-File-Name": sanitized_filename,
-        "X-Goog-Upload-Protocol": "raw",
-    }
 
-    with open(file_path, "rb") as file:
-        response = requests.post(upload_url, headers=headers, data=file)
-
-    if response.status_code == 200:
-        return response.content.decode("utf-8")
-    else:
-        print(f"Failed to upload {file_path}: {response.content}")
-        return None
-
-
-def create_media_item(session, upload_token, description="Uploaded by script"):
-    """Create a media item in Google Photos."""
-    url = "https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate"
-    headers = {
-        "Authorization": f"Bearer {session.credentials.token}",
-        "Content-type": "application/json",
-    }
-    payload = json.dumps(
-        {
-            "newMediaItems": [
-                {
-                    "description": description,
-                    "simpleMediaItem": {"uploadToken": upload_token},
-                }
-            ]
-        }
-    )
-    response = requests.post(url, headers=headers, data=payload)
-    if response.status_code == 200:
-        print("Media item created successfully.")
-    else:
-        print(f"Failed to create media item: {response.content}")
+def write_retry_queue(failed_uploads):
+    """Save failed uploads with their errors, or remove the queue if there are none."""
+    if not failed_uploads:
+        if os.path.exists(RETRY_QUEUE_FILENAME):
+            os.remove(RETRY_QUEUE_FILENAME)
+        return
+    with open(RETRY_QUEUE_FILENAME, "w") as f:
+        json.dump(
+            [{"path": path, "error": error} for path, error in failed_uploads],
+            f,
+            indent=2,
+        )
 
 
-def main(directory):
+def main(
+    directory, workers=DEFAULT_UPLOAD_WORKERS, retry_failed=False, use_ledger=True, seed=False
+):
     creds = authenticate()
     session = requests.Session()
     session.credentials = creds
 
-    successful_uploads = 0
-    failed_uploads = []
-
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(("png", "jpg", "jpeg")):
-                file_path = os.path.join(root, file)
-                try:
-                    print(f"Uploading {file_path}...")
-                    upload_token = upload_photo(session, file_path)
-                    if upload_token:
-                        create_media_item(session, upload_token)
-                        successful_uploads += 1
-                    else:
-                        failed_uploads.append(file_path)
-                except Exception as e:
-                    print(f"Error uploading {file_path}: {e}")
-                    failed_uploads.append(file_path)
+    ledger = UploadLedger.in_directory(directory) if use_ledger else None
+    if ledger and seed:
+        media_items = list_all_media_items(session)
+        added = ledger.seed(media_items)
+        print(f"Found {len(media_items)} media items in the library, {added} new to the ledger.")
 
+    if retry_failed:
+        file_paths = read_retry_queue()
+        print(f"Retrying {len(file_paths)} failed uploads from {RETRY_QUEUE_FILENAME}.")
+    else:
+        file_paths = scan_files(directory, img_formats, recursive=True)
+
+    successful_uploads, failed_uploads = upload_all(session, file_paths, workers, ledger)
+
+    # Failures may be transient, so give them a couple more rounds before giving up.
+    for _ in range(UPLOAD_ROUNDS - 1):
+        if not failed_uploads:
+            break
+        print(f"Retrying {len(failed_uploads)} failed uploads...")
+        retried, failed_uploads = upload_all(
+            session, [path for path, _ in failed_uploads], workers, ledger
+        )
+        successful_uploads += retried
+
+    if ledger:
+        ledger.close()
     print(
         f"Upload completed: {successful_uploads} files successfully uploaded, {len(failed_uploads)} files failed."
     )
 
+    write_retry_queue(failed_uploads)
     if len(failed_uploads) > 0:
-        with open("failed_uploads.txt", "w") as f:
-            for failed_file in failed_uploads:
-                f.write(f"{failed_file}\n")
-
-        print("Failed uploads written to failed_uploads.txt.")
+        print(
+            f"Failed uploads written to {RETRY_QUEUE_FILENAME}. "
+            "Run again with --retry-failed to retry them."
+        )
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python upload_photos.py <directory>")
-    else:
-        main(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Upload photos to Google Photos.")
+    parser.add_argument("directory", help="Directory to upload photos from.")
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=DEFAULT_UPLOAD_WORKERS,
+        help="Number of concurrent uploads.",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help=f"Only upload the files left in {RETRY_QUEUE_FILENAME} by an earlier run.",
+    )
+    parser.add_argument(
+        "--no-ledger",
+        dest="use_ledger",
+        action="store_false",
+        help="Upload every file, without checking or updating the upload ledger kept "
+        "in the directory.",
+    )
+    parser.add_argument(
+        "--seed-ledger",
+        action="store_true",
+        help="List the library first and add its media items to the upload ledger, so "
+        "that files matching an item already there in name, size and date are not "
+        "uploaded.",
+    )
+    args = parser.parse_args()
+    main(
+        args.directory,
+        args.workers,
+        args.retry_failed,
+        args.use_ledger,
+        args.seed_ledger,
+    )
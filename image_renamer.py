@@ -1,17 +1,278 @@
 import argparse
+import json
 import logging
 import os
-import shutil
 import sys
-from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
 
-from exif import Image
+from date_extraction import extract_all
+from dedup import DestinationIndex, plan_destination
+from durable_batch import DurableBatch
+from file_hash import hash_files
+from file_scanner import scan_files
+from file_transfer import transfer_file
+from ingest_manifest import IngestManifest, source_key
+from io_scheduler import (
+    DeviceLimits,
+    add_order_argument,
+    add_transfer_arguments,
+    group_by_directory,
+    ordered,
+)
+from metadata_cache import MetadataCache
+from metadata_extractors import media_extensions
+from metrics import NO_METRICS, Metrics, add_arguments, file_logger, finish_run
 
-img_formats = [".png", ".jpg", ".jpeg"]
+img_formats = media_extensions()
 
+PLAN_VERSION = 2
+# Plans this version can still execute. Version 1 had no "record" entries.
+SUPPORTED_PLAN_VERSIONS = (1, 2)
 
-def is_image_file(filepath):
-    return os.path.splitext(filepath)[-1].lower() in img_formats
+
+def new_sources(image_files, manifest, keys):
+    """Yield the files that the manifest has not seen, unchanged, before.
+
+    The (path, size, mtime_ns) key of each yielded file is stored in keys.
+    """
+    for f in image_files:
+        key = source_key(f)
+        if not manifest.ingested_destination(key):
+            keys[f] = key
+            yield f
+
+
+def complete_transfer(
+    logger, args, manifest, manifest_entry, src, dst, staged=None, batch=None
+):
+    """Log and record a finished transfer, or hand it to batch to be committed first."""
+    if batch is not None:
+        delete_source = staged is not None and args.delete_originals
+        batch.add([(staged, dst)], src, delete_source, tag=manifest_entry)
+        return
+    if args.delete_originals:
+        logger.info(f"Moved {src} to {dst}.")
+    else:
+        logger.info(f"Copied {src} to {dst}.")
+    if manifest:
+        key, content_hash = manifest_entry
+        manifest.record(key, content_hash, dst)
+
+
+def finish_transfer(logger, future, metrics=NO_METRICS):
+    """Wait for a transfer submitted to the pool. Returns (src, dst, staged), or None on failure."""
+    try:
+        if future.done():
+            return future.result()
+        # A transfer run by a worker is timed by how long the main process waits for it.
+        with metrics.time("copy"):
+            return future.result()
+    except Exception as e:
+        metrics.count("failed_transfer")
+        logger.warning(f"Failed to transfer file. Error: {e}")
+        return None
+
+
+def hash_extracted(extracted, cache, window, metrics=NO_METRICS):
+    """Add the content hash of each opened file to the results of extract_all().
+
+    Yields (f, opened, date_time, error, digest). Hashes stored in the metadata cache
+    are reused. The other files of each window of results are hashed together on
+    hash_files()' thread pool, and their hashes stored. A file that cannot be read
+    is yielded as not opened, with the read error.
+    """
+    extracted = iter(extracted)
+    while True:
+        results = list(islice(extracted, window))
+        if not results:
+            return
+        digests = {}
+        for f, opened, _, _ in results:
+            entry = cache.get(f) if cache and opened else None
+            if entry and entry["content_hash"]:
+                digests[f] = (entry["content_hash"], None)
+        # A file listed twice is hashed once.
+        unhashed = dict.fromkeys(f for f, opened, _, _ in results if opened)
+        unhashed = [f for f in unhashed if f not in digests]
+        for f, digest, error in metrics.timed("hash", hash_files(unhashed)):
+            digests[f] = (digest, error)
+            if digest and cache:
+                cache.put(f, content_hash=digest)
+        for f, opened, date_time, error in results:
+            digest = None
+            if opened:
+                digest, hash_error = digests[f]
+                if digest is None:
+                    opened, error = False, hash_error
+            yield f, opened, date_time, error, digest
+
+
+def plan_entry(args, f, new_filepath, manifest_entry):
+    """Describe the transfer of f to new_filepath as a line of a plan."""
+    stat = os.stat(f)
+    entry = {
+        "source": f,
+        "destination": new_filepath,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "action": "move" if args.delete_originals else "link" if args.hardlink else "copy",
+        "overwrite": args.force_overwrite and not args.skip_overwrite_prompt,
+    }
+    if manifest_entry:
+        entry["content_hash"] = manifest_entry[1]
+    return entry
+
+
+def record_entry(f, key, content_hash, destination):
+    """Describe, as a line of a plan, a source that is only added to the manifest.
+
+    f was found to be identical to destination, so it is not transferred, but an
+    incremental run records it as ingested so that it is skipped next time.
+    """
+    _, size, mtime_ns = key
+    return {
+        "source": f,
+        "destination": destination,
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "action": "record",
+        "content_hash": content_hash,
+    }
+
+
+def write_plan(plan_file, header, entries):
+    """Write a plan as JSON Lines: the header, then one transfer per line."""
+    part_file = plan_file + ".part"
+    with open(part_file, "w") as f:
+        f.write(json.dumps(header) + "\n")
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    os.replace(part_file, plan_file)
+
+
+def read_plan(plan_file):
+    """Return the (header, entries) of a plan written by write_plan."""
+    with open(plan_file) as f:
+        header = json.loads(f.readline())
+        if header.get("version") not in SUPPORTED_PLAN_VERSIONS:
+            raise ValueError(f"Unsupported plan version: {header.get('version')}")
+        entries = [json.loads(line) for line in f if line.strip()]
+    return header, entries
+
+
+def execute_plan(
+    logger, plan_file, workers=1, durable=False, metrics=NO_METRICS, limits=None
+):
+    """Carry out the transfers in a plan. Returns (transferred, planned).
+
+    Every destination in a plan is unique, so the transfers can run in parallel and in
+    any order; they are sorted by destination to keep writes to a directory together.
+    Parallel transfers are kept within the DeviceLimits limits.
+    A transfer is skipped if its source has changed since the plan was made, or if it
+    would now overwrite a file that did not exist when it was planned. Sources that
+    were planned as already ingested are added to the manifest once the transfers are
+    done, if they are unchanged and the file they are identical to exists.
+    """
+    header, entries = read_plan(plan_file)
+    recorded = [entry for entry in entries if entry["action"] == "record"]
+    entries = [entry for entry in entries if entry["action"] != "record"]
+    manifest = None
+    if header["incremental"]:
+        manifest = IngestManifest.in_directory(header["output_directory"])
+
+    def committed(src, destinations, entry):
+        action = "Moved" if entry["action"] == "move" else "Copied"
+        logger.info(f"{action} {src} to {entry['destination']}.")
+        if manifest and "content_hash" in entry:
+            key = (src, entry["size"], entry["mtime_ns"])
+            manifest.record(key, entry["content_hash"], entry["destination"])
+
+    batch = None
+    if durable:
+        batch = DurableBatch(header["output_directory"], on_commit=committed)
+
+    # One listing per destination directory, instead of a stat per destination.
+    entries.sort(key=lambda entry: entry["destination"])
+    existing = set()
+    for directory in sorted({os.path.dirname(e["destination"]) for e in entries}):
+        try:
+            existing.update(os.path.join(directory, name) for name in os.listdir(directory))
+        except FileNotFoundError:
+            os.makedirs(directory)
+            logger.info(f"Created directory: {directory}")
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        limits = limits or DeviceLimits()
+    submitted = []
+    for entry in entries:
+        src, dst = entry["source"], entry["destination"]
+        try:
+            stat = os.stat(src)
+        except OSError:
+            logger.warning(f"Skipping {src}: it no longer exists.")
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+            logger.warning(f"Skipping {src}: it has changed since the plan was made.")
+            continue
+        if not entry["overwrite"] and dst in existing:
+            logger.warning(f"Skipping {src}: {dst} has been created since the plan was made.")
+            continue
+
+        options = (
+            entry["action"] == "move",
+            entry["action"] == "link",
+            batch.temp_path(dst) if batch else None,
+        )
+        if executor is None:
+            future = Future()
+            try:
+                with metrics.time("copy"):
+                    future.set_result(transfer_file(src, dst, *options))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            device_keys = limits.acquire(src, dst)
+            future = executor.submit(transfer_file, src, dst, *options)
+            limits.track(future, device_keys)
+        submitted.append((future, entry))
+
+    converted_count = 0
+    for future, entry in submitted:
+        metrics.file_done()
+        result = finish_transfer(logger, future, metrics)
+        if not result:
+            continue
+        src, dst, staged = result
+        if batch:
+            delete_source = staged is not None and entry["action"] == "move"
+            batch.add([(staged, dst)], src, delete_source, tag=entry)
+        else:
+            committed(src, [dst], entry)
+        converted_count += 1
+
+    if executor is not None:
+        executor.shutdown()
+    if batch:
+        batch.close()
+    if manifest:
+        for entry in recorded:
+            src = entry["source"]
+            try:
+                stat = os.stat(src)
+            except OSError:
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+                continue
+            if os.path.exists(entry["destination"]):
+                key = (src, entry["size"], entry["mtime_ns"])
+                manifest.record(key, entry["content_hash"], entry["destination"])
+        manifest.close()
+    metrics.count("transferred", converted_count)
+    return converted_count, len(entries)
 
 
 def parse_args():
@@ -21,7 +282,6 @@ def parse_args():
         "-i",
         dest="input_directory",
         type=str,
-        required=True,
         help="Directory in which to search for images and rename them.",
     )
     parser.add_argument(
@@ -29,7 +289,6 @@ def parse_args():
         "-o",
         dest="output_directory",
         type=str,
-        required=True,
         help="Root directory in which to save the renamed files by year.",
     )
     parser.add_argument(
@@ -44,7 +303,8 @@ def parse_args():
         "-f",
         dest="force_overwrite",
         action="store_true",
-        help="Force overwrite of existing image files. Otherwise, a D is appended to the filename.",
+        help="Force overwrite of existing image files. Otherwise, files identical to an "
+        "existing one are skipped and other files get a numeric suffix.",
     )
     parser.add_argument(
         "--skip",
@@ -60,8 +320,69 @@ def parse_args():
         action="store_true",
         help="Moves the originals with new names. Without this option, a copy is made instead with a new name.",
     )
+    parser.add_argument(
+        "--hardlink",
+        dest="hardlink",
+        action="store_true",
+        help="Hard link files instead of copying them when the output directory is on "
+        "the same filesystem. The original and its renamed link are then one file, so "
+        "editing either changes both.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        dest="workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to read EXIF data and copy/move files.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="Do not read or update the metadata cache kept in the output directory.",
+    )
+    parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="Skip source files that an earlier --incremental run already copied or moved, "
+        "using the manifest kept in the output directory.",
+    )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--durable",
+        dest="durable",
+        action="store_true",
+        help="Write files under temporary names and make them durable in batches, so "
+        "that a crash never leaves a truncated file or loses an original. An "
+        "interrupted run is completed or rolled back by the next --durable run.",
+    )
+    parser.add_argument(
+        "--plan",
+        dest="plan_file",
+        type=str,
+        help="Do not copy or move anything. Work out every destination name and write "
+        "the transfers to this JSON Lines file, to be carried out later with --execute.",
+    )
+    parser.add_argument(
+        "--execute",
+        dest="execute_plan",
+        type=str,
+        help="Carry out the transfers in a plan written by --plan. All other options "
+        "except --workers and --durable are taken from the plan.",
+    )
+
+    add_order_argument(parser)
+    add_transfer_arguments(parser)
+    add_arguments(parser)
+
+    args = parser.parse_args()
+    if not args.execute_plan and not (args.input_directory and args.output_directory):
+        parser.error(
+            "--input-directory and --output-dir are required unless --execute is given"
+        )
+    return args
 
 
 def main():
@@ -74,6 +395,23 @@ def main():
     )
 
     logger = logging.getLogger(__name__)
+    # Messages about individual files, which can be limited with --file-log-rate.
+    flogger = file_logger(logger, args.file_log_rate)
+    metrics = Metrics("image_renamer", logger, interval=args.progress_interval)
+
+    if args.execute_plan:
+        logger.info(f"Executing plan {args.execute_plan} with args: {args}")
+        converted_count, num_files = execute_plan(
+            flogger,
+            args.execute_plan,
+            args.workers,
+            args.durable,
+            metrics,
+            DeviceLimits(args.max_reads_per_device, args.max_writes_per_device),
+        )
+        finish_run(logger, args, metrics)
+        logger.info(f"Jobs completed. Transferred {converted_count} of {num_files} files")
+        return
 
     image_dir = os.path.abspath(args.input_directory)
     args.input_directory = image_dir
@@ -89,78 +427,208 @@ def main():
 
     logger.info(f"Searching for images in {image_dir}...")
 
-    if args.recursive:
-        files = list(Path(image_dir).rglob("*"))
-    else:
-        files = list(Path(image_dir).glob("*"))
+    # Do not pick up files as they are written, if the output is inside the input.
+    image_files = scan_files(
+        image_dir,
+        img_formats,
+        args.recursive,
+        exclude=[args.output_directory] if args.output_directory != image_dir else [],
+        by_inode=args.io_order != "scan",
+    )
+    image_files = ordered(image_files, args.io_order)
 
-    image_files = list(filter(is_image_file, files))
-    num_files = len(image_files)
+    manifest = None
+    if args.incremental:
+        manifest = IngestManifest.in_directory(args.output_directory)
+        keys = {}
+        image_files = new_sources(image_files, manifest, keys)
 
-    logger.info(f"Found {num_files} files. Processing...")
+    cache = MetadataCache.in_directory(args.output_directory) if args.use_cache else None
 
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers)
+        limits = DeviceLimits(args.max_reads_per_device, args.max_writes_per_device)
+    else:
+        executor = None
+    window = args.workers * 64
+    extracted = metrics.timed(
+        "extract", extract_all(image_files, cache, executor, window=window)
+    )
+    if manifest:
+        extracted = hash_extracted(extracted, cache, window, metrics)
+    else:
+        extracted = (result + (None,) for result in extracted)
+
+    # Destination names are only ever allocated here, in the parent process and in
+    # input order, so the result does not depend on which worker finishes first.
+    # Paths handed to a worker but not yet written are tracked in pending.
+    pending = {}
+    submitted = deque()
+    plan = {}
+    run_hashes = {}
+    # With --plan, nothing is written to the manifest: sources found to be already
+    # ingested are listed in the plan, and recorded when it is executed.
+    recorded = []
+
+    def record_ingested(f, digest, destination):
+        if args.plan_file:
+            recorded.append(record_entry(f, keys[f], digest, destination))
+        else:
+            manifest.record(keys[f], digest, destination)
+    destinations = DestinationIndex(cache)
+    batch = None
+    if args.durable and not args.plan_file:
+        batch = DurableBatch(
+            args.output_directory,
+            on_commit=lambda src, dsts, entry: complete_transfer(
+                flogger, args, manifest, entry, src, dsts[0]
+            ),
+        )
     converted_count = 0
-    for f in image_files:
-        logger.info(f"Opening image: {f}...")
-        try:
-            with open(f, "rb") as img_file:
-                image = Image(img_file)
-        except Exception as e:
-            logger.warning(f"Failed to open file {f}")
-            logger.debug(e)
+
+    def transfer(f, new_filepath, manifest_entry):
+        """Copy or move f to new_filepath, or hand it to a worker to do so."""
+        nonlocal converted_count
+        temp = batch.temp_path(new_filepath) if batch else None
+        if executor is None:
+            try:
+                with metrics.time("copy"):
+                    result = transfer_file(
+                        f, new_filepath, args.delete_originals, args.hardlink, temp
+                    )
+            except OSError as e:
+                flogger.warning(f"Failed to transfer file. Error: {e}")
+                metrics.count("failed_transfer")
+                return
+            complete_transfer(flogger, args, manifest, manifest_entry, *result, batch)
+            converted_count += 1
+            return
+
+        if new_filepath in pending:
+            # Overwriting a file that is still being written: wait for it so that
+            # the later source wins, as it would in a serial run.
+            future, entry = pending.pop(new_filepath)
+            result = finish_transfer(flogger, future, metrics)
+            if result:
+                complete_transfer(flogger, args, manifest, entry, *result, batch)
+                converted_count += 1
+        device_keys = limits.acquire(f, new_filepath)
+        future = executor.submit(
+            transfer_file, f, new_filepath, args.delete_originals, args.hardlink, temp
+        )
+        limits.track(future, device_keys)
+        pending[new_filepath] = (future, manifest_entry)
+        submitted.append((new_filepath, future))
+
+        # Complete finished transfers as they come in, so that a durable batch can
+        # be committed during the run rather than all at the end.
+        while submitted and submitted[0][1].done():
+            path, future = submitted.popleft()
+            if path in pending and pending[path][0] is future:
+                _, entry = pending.pop(path)
+                result = finish_transfer(flogger, future, metrics)
+                if result:
+                    complete_transfer(flogger, args, manifest, entry, *result, batch)
+                    converted_count += 1
+
+    # Transfers are written a window at a time, grouped by destination directory,
+    # rather than jumping between year directories in the order files were read.
+    queued = []
+
+    def transfer_queued():
+        group_by_directory(queued, lambda item: item[1])
+        for item in queued:
+            transfer(*item)
+        queued.clear()
+
+    num_files = 0
+    for f, opened, date_time, error, digest in extracted:
+        num_files += 1
+        metrics.file_done()
+        flogger.info(f"Opening image: {f}...")
+        if not opened:
+            flogger.warning(f"Failed to open file {f}")
+            logger.debug(error)
+            metrics.count("failed_open")
             continue
 
-        try:
-            date_time = image.get("datetime_original")
-            if date_time is None:
-                raise ValueError("No datetime_original found in EXIF data.")
-            year = date_time.split(":")[0]  # Extract the year from datetime_original
-        except Exception as e:
-            logger.warning(
-                f"Failed to find suitable EXIF data to rename for {f}. Error: {e}"
-            )
-            # If EXIF data is not found, move/copy the image to the "Other" directory
-            year = "Other"
-
-        # Create the year directory if it doesn't exist
-        year_directory = os.path.join(args.output_directory, year)
-        if not os.path.exists(year_directory):
-            os.makedirs(year_directory)
-            logger.info(f"Created directory: {year_directory}")
+        manifest_entry = None
+        if manifest:
+            # Files handed to a worker are only in the manifest once they are written.
+            ingested = run_hashes.get(digest) or manifest.destination_for_hash(digest)
+            if ingested:
+                flogger.info(f"Skipping {f}: identical file already ingested as {ingested}.")
+                record_ingested(f, digest, ingested)
+                metrics.count("already_ingested")
+                continue
+            manifest_entry = (keys[f], digest)
 
-        try:
-            orig_ext = os.path.splitext(f)[-1]
-            new_filename = (
-                date_time.replace(":", "-").replace(" ", "_") + orig_ext
-                if date_time
-                else os.path.basename(f)
-            )
-            new_filepath = os.path.join(year_directory, new_filename)
-        except Exception as e:
-            logger.warning(f"Failed to construct new filepath for {f}. Error: {e}")
+        if not date_time:
+            logger.debug(error)
+        new_filepath, duplicate = plan_destination(
+            flogger,
+            f,
+            date_time,
+            args.output_directory,
+            destinations,
+            force_overwrite=args.force_overwrite,
+            skip_existing=args.skip_overwrite_prompt,
+            content_hash=manifest_entry[1] if manifest_entry else None,
+            create_directories=not args.plan_file,
+            metrics=metrics,
+        )
+        if duplicate and manifest_entry:
+            record_ingested(f, manifest_entry[1], duplicate)
+        if new_filepath is None:
+            metrics.count("duplicate" if duplicate else "skipped_existing")
             continue
 
-        duplicate_exists = os.path.isfile(new_filepath)
-        if duplicate_exists and args.skip_overwrite_prompt:
+        if manifest_entry:
+            run_hashes[manifest_entry[1]] = new_filepath
+
+        if args.plan_file:
+            # Only the last source for an overwritten name is transferred; the
+            # earlier ones are left where they are.
+            if plan.pop(new_filepath, None):
+                flogger.info(f"{new_filepath} is overwritten later in the plan.")
+            plan[new_filepath] = plan_entry(args, f, new_filepath, manifest_entry)
             continue
-        if not args.force_overwrite:
-            while duplicate_exists:
-                new_filepath = (
-                    os.path.splitext(new_filepath)[0]
-                    + "D"
-                    + os.path.splitext(new_filepath)[1]
-                )
-                duplicate_exists = os.path.isfile(new_filepath)
-
-        if args.delete_originals:
-            os.rename(f, new_filepath)
-            logger.info(f"Moved {f} to {new_filepath}.")
-        else:
-            shutil.copyfile(f, new_filepath)
-            logger.info(f"Copied {f} to {new_filepath}.")
 
-        converted_count += 1
+        queued.append((f, new_filepath, manifest_entry))
+        if len(queued) >= args.write_window:
+            transfer_queued()
+    transfer_queued()
+
+    if executor is not None:
+        for future, entry in pending.values():
+            result = finish_transfer(flogger, future, metrics)
+            if result:
+                complete_transfer(flogger, args, manifest, entry, *result, batch)
+                converted_count += 1
+        executor.shutdown()
+    if batch:
+        batch.close()
+    if cache:
+        cache.close()
+    if manifest:
+        manifest.close()
+
+    if args.plan_file:
+        header = {
+            "version": PLAN_VERSION,
+            "output_directory": args.output_directory,
+            "incremental": args.incremental,
+        }
+        write_plan(args.plan_file, header, list(plan.values()) + recorded)
+        finish_run(logger, args, metrics)
+        logger.info(
+            f"Jobs completed. Planned {len(plan)} transfers of {num_files} files "
+            f"in {args.plan_file}"
+        )
+        return
 
+    metrics.count("transferred", converted_count)
+    finish_run(logger, args, metrics)
     logger.info(f"Jobs completed. Renamed {converted_count} of {num_files} files")
 
 
@@ -1,18 +1,27 @@
 import argparse
 import logging
 import os
-import shutil
 import sys
-from pathlib import Path
 
-from PIL import Image
-from PIL.ExifTags import TAGS
-
-img_formats = [".png", ".jpg", ".jpeg"]
-
-
-def is_image_file(filepath):
-    return os.path.splitext(filepath)[-1].lower() in img_formats
+from dedup import DestinationIndex
+from durable_batch import DurableBatch
+from file_scanner import scan_files
+from io_scheduler import add_order_argument, ordered
+from metadata_cache import MetadataCache
+from metrics import Metrics, add_arguments, file_logger, finish_run
+from renditions import ResizeOptions, format_extensions, img_formats, resize_file
+
+def parse_rendition(value):
+    """Parse a MAX_DIM:OUTPUT_DIR[:FORMAT] rendition argument."""
+    max_dim, _, rest = value.partition(":")
+    output_directory, _, image_format = rest.partition(":")
+    if image_format and image_format.lower() not in format_extensions:
+        output_directory, image_format = rest, ""
+    if not max_dim.isdigit() or not output_directory:
+        raise argparse.ArgumentTypeError(
+            f"Expected MAX_DIM:OUTPUT_DIR[:FORMAT], got {value}"
+        )
+    return int(max_dim), output_directory, image_format.lower() or None
 
 
 def parse_args():
@@ -30,7 +39,6 @@ def parse_args():
         "-o",
         dest="output_directory",
         type=str,
-        required=True,
         help="Root directory in which to save the resized files by year.",
     )
     parser.add_argument(
@@ -65,12 +73,50 @@ def parse_args():
         "--resize_max_dim_pix",
         "--resize",
         dest="resize_max_dim_pix",
-        required=True,
         type=int,
         help="Resize the resulting image such that the greatest dimension is equal to the value. Image will scale proportionally.",
     )
+    parser.add_argument(
+        "--rendition",
+        dest="renditions",
+        action="append",
+        default=[],
+        type=parse_rendition,
+        help="Produce a rendition as MAX_DIM:OUTPUT_DIR[:FORMAT], e.g. 300:thumbs:webp. "
+        "May be given several times; each image is decoded once for all renditions. "
+        "Replaces --output-dir and --resize.",
+    )
+    parser.add_argument(
+        "--resize-speed",
+        dest="resize_speed",
+        choices=["quality", "balanced", "fast"],
+        default="balanced",
+        help="Trade resize quality for speed. 'quality' decodes every image at full "
+        "resolution; 'balanced' and 'fast' let the JPEG decoder downscale first.",
+    )
+    parser.add_argument(
+        "--durable",
+        dest="durable",
+        action="store_true",
+        help="Write renditions under temporary names and make them durable in batches, "
+        "so that a crash never leaves a truncated file or deletes an original early.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="Do not read or update the metadata cache kept in the output directory.",
+    )
+
+    add_order_argument(parser)
+    add_arguments(parser)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.renditions and (
+        args.output_directory is None or args.resize_max_dim_pix is None
+    ):
+        parser.error("either --rendition or both --output-dir and --resize are required")
+    return args
 
 
 def main():
@@ -83,122 +129,68 @@ def main():
     )
 
     logger = logging.getLogger(__name__)
+    # Messages about individual files, which can be limited with --file-log-rate.
+    flogger = file_logger(logger, args.file_log_rate)
+    metrics = Metrics("image_resizer", logger, interval=args.progress_interval)
 
     image_dir = os.path.abspath(args.input_directory)
     args.input_directory = image_dir
-    args.output_directory = os.path.abspath(args.output_directory)
+    if not args.renditions:
+        args.renditions = [(args.resize_max_dim_pix, args.output_directory, None)]
+    options = ResizeOptions(
+        args.renditions,
+        resize_speed=args.resize_speed,
+        force_overwrite=args.force_overwrite,
+        skip_existing=args.skip_overwrite_prompt,
+        delete_originals=args.delete_originals,
+    )
+    args.renditions = options.renditions
 
     logger.info(f"Initiating new run with args: {args}")
     if not os.path.isdir(image_dir):
         logger.critical(f"Specified directory was not found: {image_dir}")
         sys.exit()
-    if not os.path.isdir(args.output_directory):
-        logger.critical(f"Specified directory was not found: {args.output_directory}")
-        sys.exit()
+    for _, output_directory, _ in args.renditions:
+        if not os.path.isdir(output_directory):
+            logger.critical(f"Specified directory was not found: {output_directory}")
+            sys.exit()
 
     logger.info(f"Searching for images in {image_dir}...")
 
-    if args.recursive:
-        files = list(Path(image_dir).rglob("*"))
-    else:
-        files = list(Path(image_dir).glob("*"))
+    # Do not pick up files as they are written, if an output is inside the input.
+    output_directories = [rendition[1] for rendition in args.renditions]
+    image_files = scan_files(
+        image_dir,
+        img_formats,
+        args.recursive,
+        exclude=[directory for directory in output_directories if directory != image_dir],
+        by_inode=args.io_order != "scan",
+    )
+    image_files = ordered(image_files, args.io_order)
 
-    image_files = list(filter(is_image_file, files))
-    num_files = len(image_files)
+    cache_directory = args.renditions[0][1]
+    cache = MetadataCache.in_directory(cache_directory) if args.use_cache else None
 
-    logger.info(f"Found {num_files} files. Processing...")
+    batch = DurableBatch(cache_directory) if args.durable else None
+    destinations = DestinationIndex()
 
     converted_count = 0
+    num_files = 0
     for f in image_files:
-        logger.info(f"Opening image: {f}...")
-        try:
-            image = Image.open(f)
-        except Exception as e:
-            logger.warning(f"Failed to open file {f}")
-            logger.debug(e)
-            continue
-
-        try:
-            # Extract EXIF data for datetime
-            exif_data = image._getexif()
-            if exif_data:
-                for tag, value in exif_data.items():
-                    tag_name = TAGS.get(tag, tag)
-                    if tag_name == "DateTimeOriginal":
-                        date_time = value
-                        break
-                else:
-                    date_time = None
-            else:
-                date_time = None
-
-            if date_time is None:
-                raise ValueError("No DateTimeOriginal found in EXIF data.")
-            year = date_time.split(":")[0]  # Extract the year from DateTimeOriginal
-        except Exception as e:
-            logger.warning(
-                f"Failed to find suitable EXIF data to organize for {f}. Error: {e}"
-            )
-            year = "Other"
-
-        # Create the year directory or "Other" directory if it doesn't exist
-        year_directory = os.path.join(args.output_directory, year)
-        if not os.path.exists(year_directory):
-            os.makedirs(year_directory)
-            logger.info(f"Created directory: {year_directory}")
-
-        file_name = os.path.basename(f)
-        new_filepath = os.path.join(year_directory, file_name)
-
-        duplicate_exists = os.path.isfile(new_filepath)
-        if duplicate_exists and args.skip_overwrite_prompt:
-            continue
-        if not args.force_overwrite:
-            while duplicate_exists:
-                new_filepath = (
-                    os.path.splitext(new_filepath)[0]
-                    + "_RESIZED"
-                    + os.path.splitext(new_filepath)[1]
-                )
-                duplicate_exists = os.path.isfile(new_filepath)
-
-        max_dim = args.resize_max_dim_pix
-        x, y = image.size
-
-        biggest_dim = x if x > y else y
-
-        if max_dim > biggest_dim:
-            logger.warning(
-                f"Images can only be reduced in size. Max dimension {max_dim} is greater than image size = {image.size}"
-            )
-            shutil.copyfile(f, new_filepath)
-            continue
-
-        if x > y:
-            ratio = max_dim / float(x)
-        else:
-            ratio = max_dim / float(y)
-
-        new_x = ratio * x
-        new_y = ratio * y
-
-        resized_image = image.resize((int(new_x), int(new_y)))
-
-        try:
-            exif = image.info.get("exif")
-            resized_image.save(new_filepath, exif=exif)
-        except:
-            logger.warning(f"No EXIF data found.")
-            resized_image.save(new_filepath)
-
-        if args.delete_originals:
-            os.remove(f)
-            logger.info(f"Deleted original image: {f}")
-
-        logger.info(f"Resized {f} to {new_filepath}.")
-
-        converted_count += 1
-
+        num_files += 1
+        resized, _ = resize_file(
+            flogger, options, cache, f, batch, metrics, destinations
+        )
+        if resized:
+            converted_count += 1
+        metrics.file_done()
+
+    if batch:
+        batch.close()
+    if cache:
+        cache.close()
+
+    finish_run(logger, args, metrics)
     logger.info(f"Jobs completed. Resized {converted_count} of {num_files} files")
 
 
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import time
+
+MANIFEST_FILENAME = ".photo_manifest.sqlite"
+
+# Commit to disk every this many records, so an interrupted run keeps most of its work.
+COMMIT_INTERVAL = 100
+
+
+def source_key(filepath):
+    """Return the (absolute path, size, mtime_ns) of a file, as stored in the manifest."""
+    path = os.path.abspath(filepath)
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+class IngestManifest:
+    """Record of which source files have already been ingested, and where they went.
+
+    Each source path maps to the size, mtime and content hash it had when it was
+    copied or moved, and to its destination. A source whose size and mtime are
+    unchanged, or whose content matches an earlier source that still has its
+    destination on disk, does not need to be ingested again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                destination TEXT NOT NULL,
+                ingested_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS sources_content_hash ON sources (content_hash)"
+        )
+        self.pending_writes = 0
+
+    @classmethod
+    def in_directory(cls, directory):
+        return cls(os.path.join(directory, MANIFEST_FILENAME))
+
+    def ingested_destination(self, key):
+        """Return the destination of an unchanged, already ingested source, or None."""
+        row = self.connection.execute(
+            "SELECT destination FROM sources WHERE path = ? AND size = ? AND mtime_ns = ?",
+            key,
+        ).fetchone()
+        return row[0] if row else None
+
+    def destination_for_hash(self, content_hash):
+        """Return an existing destination holding content_hash, or None."""
+        rows = self.connection.execute(
+            "SELECT destination FROM sources WHERE content_hash = ?", (content_hash,)
+        )
+        for (destination,) in rows:
+            if os.path.isfile(destination):
+                return destination
+        return None
+
+    def record(self, key, content_hash, destination):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+            key + (content_hash, os.path.abspath(destination), time.time()),
+        )
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,181 @@
+import os
+import struct
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Orders in which input files can be processed: as listed, by inode within each
+# directory, or by where their data starts on disk.
+IO_ORDERS = ["scan", "inode", "extent"]
+
+# Files reordered together by extent order, and transfers grouped by destination
+# directory before they are written.
+WINDOW = 256
+
+# ioctl that maps the logical blocks of a file to physical ones.
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT_SIZE = 56
+
+
+def seek_bound(device):
+    """Return whether device is a spinning disk or an SD card, on which random I/O is slow."""
+    if not sys.platform.startswith("linux"):
+        return False
+    block = os.path.realpath(f"/sys/dev/block/{os.major(device)}:{os.minor(device)}")
+    if os.path.basename(block).startswith("mmcblk"):
+        return True
+    # A partition has no queue of its own; its disk is the parent directory.
+    for queue in (os.path.join(block, "queue"), os.path.join(block, "..", "queue")):
+        try:
+            with open(os.path.join(queue, "rotational")) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+
+def physical_offset(filepath):
+    """Return where the data of a file starts on its disk, or None if that is unknown."""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return None
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT_SIZE)
+    FIEMAP_HEADER.pack_into(request, 0, 0, 2**64 - 1, 0, 0, 1, 0)
+    try:
+        with open(filepath, "rb") as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    if not FIEMAP_HEADER.unpack_from(request)[3]:
+        return None  # Empty, or the data is inline in the inode.
+    return struct.unpack_from("=Q", request, FIEMAP_HEADER.size + 8)[0]
+
+
+def extent_ordered(filepaths, window=WINDOW):
+    """Yield filepaths, reordering each window of them by physical_offset().
+
+    Files whose offset is unknown keep their place after the others in the window.
+    """
+    buffered = []
+
+    def flush():
+        offsets = {path: physical_offset(path) for path in buffered}
+        buffered.sort(key=lambda path: (offsets[path] is None, offsets[path] or 0))
+        yield from buffered
+        buffered.clear()
+
+    for filepath in filepaths:
+        buffered.append(filepath)
+        if len(buffered) >= window:
+            yield from flush()
+    yield from flush()
+
+
+def group_by_directory(items, destination):
+    """Sort a list of items by the directory of destination(item).
+
+    Items for the same directory keep their relative order.
+    """
+    items.sort(key=lambda item: os.path.dirname(destination(item)))
+
+
+class DeviceLimits:
+    """Caps the transfers in flight that read from, and that write to, each device.
+
+    A limit of None means one at a time on spinning disks and SD cards, which slow
+    to a crawl when several files are read or written at once, and no cap elsewhere.
+    """
+
+    def __init__(self, read_limit=None, write_limit=None):
+        self.limits = {"read": read_limit, "write": write_limit}
+        self.devices = {}  # directory -> device
+        self.seek_bound = {}  # device -> bool
+        self.in_flight = {}  # (kind, device) -> number of transfers
+        self.condition = threading.Condition()
+
+    def _device(self, path):
+        directory = os.path.dirname(path)
+        if directory not in self.devices:
+            self.devices[directory] = os.stat(directory).st_dev
+        return self.devices[directory]
+
+    def _limit(self, kind, device):
+        if self.limits[kind] is not None:
+            return self.limits[kind]
+        if device not in self.seek_bound:
+            self.seek_bound[device] = seek_bound(device)
+        return 1 if self.seek_bound[device] else None
+
+    def acquire(self, src, dst):
+        """Wait until a transfer from src to dst is within the limits, and count it."""
+        keys = [("read", self._device(src)), ("write", self._device(dst))]
+        limits = [self._limit(*key) for key in keys]
+        with self.condition:
+            self.condition.wait_for(
+                lambda: all(
+                    limit is None or self.in_flight.get(key, 0) < limit
+                    for key, limit in zip(keys, limits)
+                )
+            )
+            for key in keys:
+                self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        return keys
+
+    def release(self, keys):
+        with self.condition:
+            for key in keys:
+                self.in_flight[key] -= 1
+            self.condition.notify_all()
+
+    def track(self, future, keys):
+        """Release keys, as returned by acquire(), when future is done."""
+        future.add_done_callback(lambda _: self.release(keys))
+
+
+def ordered(filepaths, io_order):
+    """Reorder files from scan_files for io_order. The "inode" order is scan_files' own."""
+    if io_order == "extent":
+        return extent_ordered(filepaths)
+    return filepaths
+
+
+def add_order_argument(parser):
+    parser.add_argument(
+        "--io-order",
+        dest="io_order",
+        choices=IO_ORDERS,
+        default="inode",
+        help="Order in which to read input files: as the directory lists them, by "
+        "inode within each directory (the default, which on most filesystems follows "
+        "their place on disk), or by the disk location of their data, which takes an "
+        "extra system call per file but suits spinning disks best.",
+    )
+
+
+def add_transfer_arguments(parser):
+    parser.add_argument(
+        "--write-window",
+        dest="write_window",
+        type=int,
+        default=WINDOW,
+        help="Group this many transfers at a time by destination directory before "
+        f"writing them. Defaults to {WINDOW}; 1 writes in input order.",
+    )
+    parser.add_argument(
+        "--max-reads-per-device",
+        dest="max_reads_per_device",
+        type=int,
+        help="Most transfers with --workers reading from one device at a time. "
+        "Defaults to 1 on spinning disks and SD cards and no limit elsewhere.",
+    )
+    parser.add_argument(
+        "--max-writes-per-device",
+        dest="max_writes_per_device",
+        type=int,
+        help="Most transfers with --workers writing to one device at a time. "
+        "Defaults to 1 on spinning disks and SD cards and no limit elsewhere.",
+    )
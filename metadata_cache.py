@@ -0,0 +1,123 @@
+import os
+import sqlite3
+
+CACHE_FILENAME = ".photo_metadata.sqlite"
+
+# Commit to disk every this many writes, so an interrupted run keeps most of its work.
+COMMIT_INTERVAL = 500
+
+
+class MetadataCache:
+    """On-disk cache of per-file image metadata.
+
+    Entries are keyed by (absolute path, size, mtime_ns), so a file that has been
+    modified since it was cached is simply a miss. Each entry may hold the EXIF
+    DateTimeOriginal, the image dimensions, a content hash and a perceptual hash.
+    A date_time of "" means the file was checked and has no EXIF date, while None
+    means unknown.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS metadata (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                date_time TEXT,
+                width INTEGER,
+                height INTEGER,
+                content_hash TEXT,
+                perceptual_hash TEXT,
+                PRIMARY KEY (path, size, mtime_ns)
+            )
+            """
+        )
+        # Caches written before perceptual hashes were stored lack the column.
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(metadata)")]
+        if "perceptual_hash" not in columns:
+            self.connection.execute(
+                "ALTER TABLE metadata ADD COLUMN perceptual_hash TEXT"
+            )
+        self.pending_writes = 0
+
+    @classmethod
+    def in_directory(cls, directory):
+        return cls(os.path.join(directory, CACHE_FILENAME))
+
+    def get(self, filepath):
+        """Return the cached entry for a file as a dict, or None on a miss."""
+        try:
+            key = _cache_key(filepath)
+        except OSError:
+            return None
+        row = self.connection.execute(
+            "SELECT date_time, width, height, content_hash, perceptual_hash FROM metadata "
+            "WHERE path = ? AND size = ? AND mtime_ns = ?",
+            key,
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "date_time": row[0],
+            "width": row[1],
+            "height": row[2],
+            "content_hash": row[3],
+            "perceptual_hash": row[4],
+        }
+
+    def put(
+        self,
+        filepath,
+        date_time=None,
+        width=None,
+        height=None,
+        content_hash=None,
+        perceptual_hash=None,
+    ):
+        """Store metadata for a file. Fields passed as None keep their cached value."""
+        try:
+            key = _cache_key(filepath)
+        except OSError:
+            return
+        self.connection.execute(
+            """
+            INSERT INTO metadata (
+                path, size, mtime_ns, date_time, width, height, content_hash, perceptual_hash
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path, size, mtime_ns) DO UPDATE SET
+                date_time = COALESCE(excluded.date_time, date_time),
+                width = COALESCE(excluded.width, width),
+                height = COALESCE(excluded.height, height),
+                content_hash = COALESCE(excluded.content_hash, content_hash),
+                perceptual_hash = COALESCE(excluded.perceptual_hash, perceptual_hash)
+            """,
+            key + (date_time, width, height, content_hash, perceptual_hash),
+        )
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def _cache_key(filepath):
+    path = os.path.abspath(filepath)
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+def cached_date_time(entry):
+    """Return (known, date_time) for a cache entry, as returned by MetadataCache.get."""
+    if entry is None or entry["date_time"] is None:
+        return False, None
+    return True, entry["date_time"] or None
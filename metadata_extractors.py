@@ -0,0 +1,297 @@
+"""Header-only readers of the capture date of photos and videos.
+
+Each extractor is registered with the file extensions it handles and a test of the
+first bytes of a file. read_date_time() picks the extractor by those bytes rather
+than by extension, so a HEIC saved as .jpg is still read correctly. New formats
+are added with the register() decorator:
+
+    @register("webp", [".webp"], lambda header: header[8:12] == b"WEBP")
+    def read_webp(media_file, max_bytes):
+        ...
+
+An extractor reads no more than max_bytes of metadata, and returns the date as
+"YYYY:MM:DD HH:MM:SS", NO_DATE if the file certainly has none, or None if it could
+not tell, in which case callers may fall back to a slower full parser.
+"""
+import os
+import struct
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from exif_reader import (
+    EXIF_HEADER,
+    JPEG_SOI,
+    MAX_HEADER_BYTES,
+    PNG_SIGNATURE,
+    parse_datetime_original,
+    read_exif_block,
+)
+
+# Returned when the metadata was read and holds no date. The metadata cache stores
+# the same value for files known to have no date.
+NO_DATE = ""
+
+# Bytes at the start of a file passed to the signature tests.
+HEADER_BYTES = 16
+
+# QuickTime and MP4 times count seconds from the start of 1904, in UTC.
+QUICKTIME_EPOCH = datetime(1904, 1, 1, tzinfo=timezone.utc)
+
+# Most boxes looked at on one level of an ISO-BMFF file before giving up.
+MAX_BOXES = 64
+
+
+@dataclass(frozen=True)
+class Extractor:
+    name: str
+    extensions: tuple
+    matches: object  # header bytes -> bool
+    read: object  # (open file, max_bytes) -> date, NO_DATE or None
+
+
+EXTRACTORS = []
+
+
+def register(name, extensions, matches):
+    """Register the decorated function to read the files that matches() accepts."""
+
+    def decorator(read):
+        EXTRACTORS.append(Extractor(name, tuple(extensions), matches, read))
+        return read
+
+    return decorator
+
+
+def media_extensions():
+    """Return the extensions of every format an extractor is registered for."""
+    return sorted({ext for extractor in EXTRACTORS for ext in extractor.extensions})
+
+
+def extractor_for(header):
+    for extractor in EXTRACTORS:
+        if extractor.matches(header):
+            return extractor
+    return None
+
+
+def read_date_time(filepath, max_bytes=MAX_HEADER_BYTES):
+    """Return the capture date of a photo or video, reading only its headers.
+
+    Returns the date as "YYYY:MM:DD HH:MM:SS", NO_DATE if the file has no date, or
+    None if its format is not recognised or its metadata could not be read.
+    """
+    try:
+        with open(filepath, "rb") as media_file:
+            header = media_file.read(HEADER_BYTES)
+            extractor = extractor_for(header)
+            if extractor is None:
+                return None
+            media_file.seek(0)
+            return extractor.read(media_file, max_bytes)
+    except OSError:
+        return None
+
+
+def _date_from_tiff(tiff):
+    if tiff is None:
+        return None
+    if not tiff:
+        return NO_DATE
+    try:
+        return parse_datetime_original(tiff) or NO_DATE
+    except (struct.error, IndexError, UnicodeDecodeError):
+        return None  # Damaged or cut short by max_bytes.
+
+
+@register("jpeg", [".jpg", ".jpeg"], lambda header: header.startswith(JPEG_SOI))
+@register("png", [".png"], lambda header: header.startswith(PNG_SIGNATURE))
+def read_exif_image(media_file, max_bytes):
+    return _date_from_tiff(read_exif_block(media_file, max_bytes))
+
+
+# DNG and most raw formats (CR2, NEF, ARW) are TIFF files, with EXIF in their IFDs.
+@register(
+    "tiff",
+    [".dng", ".cr2", ".nef", ".arw", ".tif", ".tiff"],
+    lambda header: header[:4] in (b"II*\x00", b"MM\x00*"),
+)
+def read_tiff(media_file, max_bytes):
+    return _date_from_tiff(media_file.read(max_bytes))
+
+
+# HEIC and HEIF photos and MP4, MOV and 3GP videos are ISO base media files: a
+# sequence of boxes, starting with ftyp except in some old QuickTime files.
+@register(
+    "isobmff",
+    [".heic", ".heif", ".mov", ".mp4", ".m4v", ".3gp"],
+    lambda header: header[4:8] in (b"ftyp", b"moov", b"mdat", b"wide"),
+)
+def read_isobmff(media_file, max_bytes):
+    size = os.fstat(media_file.fileno()).st_size
+    boxes = {}
+    for box_type, start, end in _boxes(media_file, 0, size):
+        if box_type in (b"meta", b"moov"):
+            boxes[box_type] = (start, end)
+    if b"meta" in boxes:
+        # HEIF: the EXIF block is an item of the top-level meta box.
+        start, end = boxes[b"meta"]
+        date_time = _read_heif_exif(media_file, start + 4, end, max_bytes)
+        if date_time or b"moov" not in boxes:
+            return date_time
+    if b"moov" in boxes:
+        return _read_mvhd(media_file, *boxes[b"moov"])
+    return None
+
+
+def _boxes(media_file, start, end):
+    """Yield (type, payload start, payload end) of the boxes between start and end."""
+    position = start
+    for _ in range(MAX_BOXES):
+        if position + 8 > end:
+            return
+        media_file.seek(position)
+        header = media_file.read(8)
+        if len(header) < 8:
+            return
+        box_size, box_type = struct.unpack(">I4s", header)
+        payload = position + 8
+        if box_size == 1:
+            large = media_file.read(8)
+            if len(large) < 8:
+                return
+            (box_size,) = struct.unpack(">Q", large)
+            payload += 8
+        elif box_size == 0:
+            box_size = end - position  # Extends to the end of the file.
+        if box_size < payload - position:
+            return
+        yield box_type, payload, min(position + box_size, end)
+        position += box_size
+
+
+def _read_mvhd(media_file, start, end):
+    for box_type, payload, _ in _boxes(media_file, start, end):
+        if box_type != b"mvhd":
+            continue
+        media_file.seek(payload)
+        data = media_file.read(12)
+        if len(data) < 12:
+            return None
+        if data[0] == 1:
+            (seconds,) = struct.unpack(">Q", data[4:12])
+        else:
+            (seconds,) = struct.unpack(">I", data[4:8])
+        if seconds == 0:
+            return NO_DATE  # Not set by the camera.
+        try:
+            created = QUICKTIME_EPOCH + timedelta(seconds=seconds)
+        except OverflowError:
+            return None
+        # Photos carry the local time they were taken, so videos should too.
+        return created.astimezone().strftime("%Y:%m:%d %H:%M:%S")
+    return None
+
+
+def _read_heif_exif(media_file, start, end, max_bytes):
+    exif_ids = set()
+    locations = None
+    for box_type, payload, box_end in _boxes(media_file, start, end):
+        if box_type not in (b"iinf", b"iloc"):
+            continue
+        if box_end - payload > max_bytes:
+            return None
+        media_file.seek(payload)
+        data = media_file.read(box_end - payload)
+        try:
+            if box_type == b"iinf":
+                exif_ids = _parse_iinf(data)
+            else:
+                locations = _parse_iloc(data)
+        except (struct.error, IndexError):
+            return None
+    if locations is None:
+        return None
+    if not exif_ids:
+        return NO_DATE
+
+    for item_id in exif_ids:
+        extents = locations.get(item_id)
+        if extents is None:
+            return None
+        data = b""
+        for offset, length in extents:
+            media_file.seek(offset)
+            data += media_file.read(min(length, max_bytes - len(data)))
+        if len(data) < 4:
+            return None
+        # The item starts with the offset of the TIFF header, usually past "Exif\0\0".
+        (tiff_offset,) = struct.unpack(">I", data[:4])
+        tiff = data[4 + tiff_offset :]
+        if tiff.startswith(EXIF_HEADER):
+            tiff = tiff[len(EXIF_HEADER) :]
+        return _date_from_tiff(tiff)
+
+
+def _parse_iinf(data):
+    """Return the ids of the Exif items listed in an iinf box."""
+    version = data[0]
+    position = 6 if version == 0 else 8
+    exif_ids = set()
+    while position + 8 <= len(data):
+        infe_size, box_type = struct.unpack_from(">I4s", data, position)
+        if infe_size < 8:
+            break
+        if box_type == b"infe":
+            infe_version = data[position + 8]
+            if infe_version >= 2:
+                entry = position + 12
+                if infe_version == 2:
+                    (item_id,) = struct.unpack_from(">H", data, entry)
+                    entry += 2
+                else:
+                    (item_id,) = struct.unpack_from(">I", data, entry)
+                    entry += 4
+                item_type = data[entry + 2 : entry + 6]
+                if item_type == b"Exif":
+                    exif_ids.add(item_id)
+        position += infe_size
+    return exif_ids
+
+
+def _parse_iloc(data):
+    """Return {item id: [(file offset, length), ...]} from an iloc box.
+
+    Only items stored in the file itself are included, with their extents in order.
+    """
+    version = data[0]
+    offset_size = data[4] >> 4
+    length_size = data[4] & 0x0F
+    base_offset_size = data[5] >> 4
+    index_size = data[5] & 0x0F if version in (1, 2) else 0
+    position = 6
+
+    def read(size):
+        nonlocal position
+        if size == 0:
+            return 0
+        value = int.from_bytes(data[position : position + size], "big")
+        if position + size > len(data):
+            raise IndexError("iloc box cut short")
+        position += size
+        return value
+
+    item_count = read(2 if version < 2 else 4)
+    locations = {}
+    for _ in range(item_count):
+        item_id = read(2 if version < 2 else 4)
+        construction_method = read(2) & 0x0F if version in (1, 2) else 0
+        read(2)  # data_reference_index
+        base_offset = read(base_offset_size)
+        extent_count = read(2)
+        extents = []
+        for _ in range(extent_count):
+            read(index_size)
+            extents.append((base_offset + read(offset_size), read(length_size)))
+        if construction_method == 0 and extents:
+            locations[item_id] = extents
+    return locations
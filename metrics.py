@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+# Log a throughput summary at most this often, in seconds.
+PROGRESS_INTERVAL = 30
+
+
+class Metrics:
+    """Per-stage timers, latency histograms and counters for one run of a tool.
+
+    Time a stage with "with metrics.time('copy'):", count events with count(), and
+    call file_done() once per input file to get a periodic throughput and ETA line
+    in the log. write() exports everything as JSON, or as a Prometheus textfile if
+    the path ends in .prom.
+    """
+
+    def __init__(self, tool, logger=None, total=None, interval=PROGRESS_INTERVAL):
+        self.tool = tool
+        self.logger = logger or logging.getLogger(tool)
+        self.total = total
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.files_done = 0
+        self.counters = {}
+        self.stages = {}  # stage -> [count, total seconds, bucket counts]
+
+    @contextmanager
+    def time(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage, seconds):
+        """Record that stage took seconds."""
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = [0, 0.0, [0] * len(BUCKETS)]
+        entry[0] += 1
+        entry[1] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                entry[2][i] += 1
+                break
+
+    def timed(self, stage, iterable):
+        """Yield the items of iterable, timing how long each one takes to produce."""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(stage, time.perf_counter() - started)
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def file_done(self):
+        self.files_done += 1
+        if self.interval and time.monotonic() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        """Log the throughput so far and, if the total is known, the time left."""
+        now = time.monotonic()
+        self.last_report = now
+        elapsed = now - self.started
+        rate = self.files_done / elapsed if elapsed else 0
+        message = f"Processed {self.files_done}"
+        if self.total:
+            message += f" of {self.total}"
+        message += f" files, {rate:.1f} files/s"
+        if self.total and rate:
+            remaining = (self.total - self.files_done) / rate
+            message += f", ETA {_format_duration(remaining)}"
+        slowest = sorted(self.stages.items(), key=lambda item: -item[1][1])[:3]
+        if slowest:
+            message += ". Time by stage: " + ", ".join(
+                f"{stage} {entry[1]:.1f} s" for stage, entry in slowest
+            )
+        self.logger.info(message)
+
+    def as_dict(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "tool": self.tool,
+            "elapsed_seconds": elapsed,
+            "files": self.files_done,
+            "files_per_second": self.files_done / elapsed if elapsed else None,
+            "counters": dict(self.counters),
+            "stages": {
+                stage: {
+                    "count": count,
+                    "seconds": seconds,
+                    "buckets": {
+                        str(bound): bucket for bound, bucket in zip(BUCKETS, buckets)
+                    },
+                }
+                for stage, (count, seconds, buckets) in self.stages.items()
+            },
+        }
+
+    def as_prometheus(self):
+        labels = f'tool="{self.tool}"'
+        lines = [
+            "# HELP photo_files_total Input files processed.",
+            "# TYPE photo_files_total counter",
+            f"photo_files_total{{{labels}}} {self.files_done}",
+            "# HELP photo_events_total Events counted by the tool.",
+            "# TYPE photo_events_total counter",
+        ]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'photo_events_total{{{labels},event="{name}"}} {value}')
+        lines += [
+            "# HELP photo_stage_seconds Time spent in each stage.",
+            "# TYPE photo_stage_seconds histogram",
+        ]
+        for stage, (count, seconds, buckets) in sorted(self.stages.items()):
+            stage_labels = f'{labels},stage="{stage}"'
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(
+                    f'photo_stage_seconds_bucket{{{stage_labels},le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'photo_stage_seconds_bucket{{{stage_labels},le="+Inf"}} {count}')
+            lines.append(f"photo_stage_seconds_sum{{{stage_labels}}} {seconds}")
+            lines.append(f"photo_stage_seconds_count{{{stage_labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # Written under a temporary name first, so a collector never reads half a file.
+        part_path = path + ".part"
+        with open(part_path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.as_prometheus())
+            else:
+                json.dump(self.as_dict(), f, indent=2)
+        os.replace(part_path, path)
+
+
+class NullMetrics(Metrics):
+    """Metrics that records nothing, for callers that do not collect any."""
+
+    def __init__(self):
+        super().__init__("none", interval=0)
+
+    def observe(self, stage, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def file_done(self):
+        pass
+
+
+NO_METRICS = NullMetrics()
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most rate INFO records per second. Warnings always pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.window = None
+        self.passed = 0
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.rate <= 0:
+            self.dropped += 1
+            return False
+        window = int(time.monotonic())
+        if window != self.window:
+            self.window = window
+            self.passed = 0
+        if self.passed >= self.rate:
+            self.dropped += 1
+            return False
+        self.passed += 1
+        return True
+
+
+def add_arguments(parser):
+    """Add the instrumentation options shared by the tools to an argparse parser."""
+    parser.add_argument(
+        "--metrics-file",
+        dest="metrics_file",
+        type=str,
+        help="Write per-stage timings and counters to this file when the run ends: "
+        "a Prometheus textfile if it ends in .prom, JSON otherwise.",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        dest="progress_interval",
+        type=float,
+        default=PROGRESS_INTERVAL,
+        help="Log throughput and time left every this many seconds. 0 disables it.",
+    )
+    parser.add_argument(
+        "--file-log-rate",
+        dest="file_log_rate",
+        type=int,
+        help="Log at most this many per-file messages a second, 0 for none. Warnings "
+        "are always logged. By default every message is logged.",
+    )
+
+
+def file_logger(logger, rate=None):
+    """Return the child of logger for per-file messages, limited to rate a second."""
+    child = logger.getChild("files")
+    if rate is not None:
+        child.addFilter(RateLimitFilter(rate))
+    return child
+
+
+def finish_run(logger, args, metrics):
+    """Log the final throughput summary and write the metrics file, if one was asked for."""
+    if args.progress_interval:
+        metrics.report()
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
+        logger.info(f"Wrote metrics to {args.metrics_file}")
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
@@ -0,0 +1,280 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+
+from PIL import Image
+
+from file_scanner import scan_files
+from metadata_cache import MetadataCache
+
+img_formats = [".png", ".jpg", ".jpeg"]
+
+# dHash compares each pixel of a 9x8 grayscale thumbnail with its right neighbour.
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+HASH_BITS = (HASH_WIDTH - 1) * HASH_HEIGHT
+
+
+def dhash(image):
+    """Return the 64-bit difference hash of a Pillow image as an int."""
+    # Let the JPEG decoder downscale in the DCT domain; only a few pixels are needed.
+    image.draft("L", (HASH_WIDTH * 8, HASH_HEIGHT * 8))
+    thumbnail = image.convert("L").resize(
+        (HASH_WIDTH, HASH_HEIGHT), Image.Resampling.BILINEAR
+    )
+    pixels = list(thumbnail.getdata())
+    value = 0
+    for row in range(HASH_HEIGHT):
+        for col in range(HASH_WIDTH - 1):
+            left = pixels[row * HASH_WIDTH + col]
+            right = pixels[row * HASH_WIDTH + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+class HashIndex:
+    """Multi-index hash table for finding hashes within a Hamming distance.
+
+    The hash bits are split into max_distance + 1 chunks. Two hashes that differ in
+    at most max_distance bits must agree exactly on at least one chunk, so only the
+    hashes sharing a chunk value need to be compared, rather than every pair.
+    """
+
+    def __init__(self, max_distance, bits=HASH_BITS):
+        self.max_distance = max_distance
+        num_chunks = max_distance + 1
+        chunk_size, extra = divmod(bits, num_chunks)
+        self.chunks = []
+        start = 0
+        for i in range(num_chunks):
+            width = chunk_size + (1 if i < extra else 0)
+            self.chunks.append((start, (1 << width) - 1))
+            start += width
+        self.tables = [{} for _ in self.chunks]
+
+    def _chunk_values(self, value):
+        return [(value >> start) & mask for start, mask in self.chunks]
+
+    def query(self, value):
+        """Return the ids of all added hashes within max_distance of value."""
+        found = set()
+        for table, chunk in zip(self.tables, self._chunk_values(value)):
+            for other_value, item_id in table.get(chunk, ()):
+                if item_id not in found:
+                    if (value ^ other_value).bit_count() <= self.max_distance:
+                        found.add(item_id)
+        return found
+
+    def add(self, value, item_id):
+        for table, chunk in zip(self.tables, self._chunk_values(value)):
+            table.setdefault(chunk, []).append((value, item_id))
+
+
+def find_clusters(hashes, max_distance):
+    """Group items whose hashes are within max_distance of each other.
+
+    hashes is a list of ints. Returns a list of clusters, each a sorted list of
+    indices into hashes, for every group of two or more near-duplicates.
+    """
+    parent = list(range(len(hashes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    index = HashIndex(max_distance)
+    for i, value in enumerate(hashes):
+        for j in index.query(value):
+            parent[find(i)] = find(j)
+        index.add(value, i)
+
+    groups = {}
+    for i in range(len(hashes)):
+        groups.setdefault(find(i), []).append(i)
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+
+def split_cluster(cluster, hashes, max_distance, rank):
+    """Split a cluster into groups of an image to keep and its near-duplicates.
+
+    Clusters are linked transitively, so a burst of frames can chain images that
+    look nothing alike. The best image left by rank is kept, and only those within
+    max_distance of it are its duplicates; the rest are split the same way. Returns
+    a list of (keep, duplicates), leaving out images with no near-duplicate.
+    """
+    remaining = sorted(cluster, key=rank)
+    groups = []
+    while remaining:
+        keep, *others = remaining
+        duplicates = [
+            i for i in others if (hashes[i] ^ hashes[keep]).bit_count() <= max_distance
+        ]
+        if duplicates:
+            groups.append((keep, duplicates))
+        remaining = [i for i in others if i not in duplicates]
+    return groups
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Find visually identical photos, such as a phone original and "
+        "its recompressed Google Photos download."
+    )
+    parser.add_argument(
+        "--input-directory",
+        "-i",
+        dest="input_directory",
+        type=str,
+        required=True,
+        help="Directory in which to search for near-duplicate images.",
+    )
+    parser.add_argument(
+        "--recursive",
+        "-r",
+        dest="recursive",
+        action="store_true",
+        help="Search for images recursively in directories.",
+    )
+    parser.add_argument(
+        "--max-distance",
+        "-m",
+        dest="max_distance",
+        type=int,
+        default=4,
+        help="Maximum number of differing hash bits (out of 64) for two images to be "
+        "considered near-duplicates.",
+    )
+    parser.add_argument(
+        "--report",
+        dest="report",
+        type=str,
+        help="Write the duplicate clusters to this JSON file.",
+    )
+    parser.add_argument(
+        "--collapse-to",
+        dest="collapse_directory",
+        type=str,
+        help="Keep the largest image of each cluster and move the others into this "
+        "directory. Without this option, clusters are only reported.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="Do not read or update the metadata cache kept in the input directory.",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(
+        handlers=[logging.FileHandler("debug.log"), logging.StreamHandler()],
+        format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
+        datefmt="%H:%M:%S",
+        level=logging.INFO,
+    )
+
+    logger = logging.getLogger(__name__)
+
+    image_dir = os.path.abspath(args.input_directory)
+    args.input_directory = image_dir
+
+    logger.info(f"Initiating new run with args: {args}")
+    if not os.path.isdir(image_dir):
+        logger.critical(f"Specified directory was not found: {image_dir}")
+        sys.exit()
+    if args.collapse_directory:
+        args.collapse_directory = os.path.abspath(args.collapse_directory)
+        if not os.path.isdir(args.collapse_directory):
+            os.makedirs(args.collapse_directory)
+
+    logger.info(f"Searching for images in {image_dir}...")
+
+    image_files = scan_files(
+        image_dir,
+        img_formats,
+        args.recursive,
+        exclude=[args.collapse_directory] if args.collapse_directory else [],
+    )
+
+    cache = MetadataCache.in_directory(image_dir) if args.use_cache else None
+
+    paths = []
+    hashes = []
+    pixels = []
+    for f in image_files:
+        entry = cache.get(f) if cache else None
+        if entry and entry["perceptual_hash"] and entry["width"] is not None:
+            value = int(entry["perceptual_hash"], 16)
+            width, height = entry["width"], entry["height"]
+        else:
+            try:
+                with Image.open(f) as image:
+                    width, height = image.size
+                    value = dhash(image)
+            except Exception as e:
+                logger.warning(f"Failed to hash file {f}")
+                logger.debug(e)
+                continue
+            if cache:
+                cache.put(f, width=width, height=height, perceptual_hash=f"{value:016x}")
+        paths.append(f)
+        hashes.append(value)
+        pixels.append(width * height)
+
+    if cache:
+        cache.close()
+
+    # Keep the highest resolution copy, then the largest file, which is normally the
+    # camera original rather than a recompressed download.
+    def rank(i):
+        return -pixels[i], -os.path.getsize(paths[i]), paths[i]
+
+    groups = [
+        group
+        for cluster in find_clusters(hashes, args.max_distance)
+        for group in split_cluster(cluster, hashes, args.max_distance, rank)
+    ]
+
+    report = []
+    moved_count = 0
+    for keep, duplicates in groups:
+        keep = paths[keep]
+        duplicates = [paths[i] for i in duplicates]
+        logger.info(f"Near-duplicates of {keep}: {', '.join(duplicates)}")
+        report.append({"keep": keep, "duplicates": duplicates})
+
+        if args.collapse_directory:
+            for duplicate in duplicates:
+                name, ext = os.path.splitext(os.path.basename(duplicate))
+                new_filepath = os.path.join(args.collapse_directory, name + ext)
+                suffix = 0
+                while os.path.exists(new_filepath):
+                    suffix += 1
+                    new_filepath = os.path.join(
+                        args.collapse_directory, f"{name}_{suffix}{ext}"
+                    )
+                shutil.move(duplicate, new_filepath)
+                logger.info(f"Moved {duplicate} to {new_filepath}.")
+                moved_count += 1
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+        logger.info(f"Wrote duplicate report to {args.report}")
+
+    logger.info(
+        f"Jobs completed. Found {len(groups)} near-duplicate clusters among "
+        f"{len(paths)} files. Moved {moved_count} files."
+    )
+
+
+if __name__ == "__main__":
+    main()
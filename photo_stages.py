@@ -0,0 +1,219 @@
+"""Reusable stages for processing photos in-process.
+
+Each stage works on PhotoRecord objects. Calling a stage on an iterable of records
+yields the records it processed, skipping those it dropped, so stages can be chained:
+
+    cache = MetadataCache.in_directory(output_dir)
+    records = scan(input_dir)
+    records = MetadataExtractor(cache)(records)
+    records = DestinationPlanner(output_dir, cache)(records)
+    records = Transferrer()(records)
+    records = Resizer([(1200, backup_dir, None)])(records)
+    Uploader(session)(records)
+
+Stages can also be fed one record at a time with process(), which returns the record
+or None, for use from a queue or thread pool. Nothing here parses command line
+arguments or configures logging.
+"""
+import logging
+import os
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+
+from date_extraction import extract_date_time
+from dedup import DestinationIndex, plan_destination
+from file_scanner import scan_files
+from file_transfer import transfer_file
+from metadata_cache import cached_date_time
+from metadata_extractors import media_extensions
+from photos_api import DEFAULT_UPLOAD_WORKERS, upload_all
+from renditions import ResizeOptions, is_image_file, resize_file
+
+img_formats = media_extensions()
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PhotoRecord:
+    """A photo moving through the stages."""
+
+    path: str
+    date_time: str = None
+    destination: str = None
+    outputs: list = field(default_factory=list)
+
+
+class Stage(ABC):
+    """A step applied to records one at a time."""
+
+    @abstractmethod
+    def process(self, record):
+        """Return the processed record, or None to drop it."""
+
+    def __call__(self, records):
+        for record in records:
+            result = self.process(record)
+            if result is not None:
+                yield result
+
+
+def scan(directory, recursive=True, extensions=img_formats, exclude=(), by_inode=True):
+    """Yield a PhotoRecord for every image file in directory.
+
+    With by_inode, the files of each directory come in inode order, which keeps
+    reads from a spinning disk or SD card close together.
+    """
+    for filepath in scan_files(directory, extensions, recursive, exclude, by_inode):
+        yield PhotoRecord(filepath)
+
+
+class MetadataExtractor(Stage):
+    """Read the EXIF DateTimeOriginal of each record, using the cache if given.
+
+    Files that cannot be opened are dropped. Files without a date are passed on
+    with date_time set to None.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def process(self, record):
+        known, date_time = cached_date_time(
+            self.cache.get(record.path) if self.cache else None
+        )
+        if not known:
+            _, opened, date_time, error = extract_date_time(record.path)
+            if not opened:
+                logger.warning(f"Failed to open file {record.path}")
+                logger.debug(error)
+                return None
+            if self.cache:
+                self.cache.put(record.path, date_time=date_time or "")
+        record.date_time = date_time
+        return record
+
+
+class DestinationPlanner(Stage):
+    """Choose the year directory and name each record is saved under.
+
+    Records identical to a file already in output_directory, or whose name is taken
+    when skip_existing is set, are dropped. Names are allocated in the order records
+    arrive, so a planner should only be used from one thread at a time.
+    """
+
+    def __init__(
+        self,
+        output_directory,
+        cache=None,
+        force_overwrite=False,
+        skip_existing=False,
+        destinations=None,
+    ):
+        self.output_directory = os.path.abspath(output_directory)
+        # Planners with different options can share an index of the same directory.
+        self.destinations = destinations or DestinationIndex(cache)
+        self.force_overwrite = force_overwrite
+        self.skip_existing = skip_existing
+
+    def process(self, record):
+        new_filepath, _ = plan_destination(
+            logger,
+            record.path,
+            record.date_time,
+            self.output_directory,
+            self.destinations,
+            force_overwrite=self.force_overwrite,
+            skip_existing=self.skip_existing,
+        )
+        if new_filepath is None:
+            return None
+        record.destination = new_filepath
+        return record
+
+
+class Transferrer(Stage):
+    """Copy, or with delete_originals move, each record to its destination.
+
+    With hardlink, copies on the same filesystem are hard links instead. Afterwards
+    the record's path is its new location.
+    """
+
+    def __init__(self, delete_originals=False, hardlink=False):
+        self.delete_originals = delete_originals
+        self.hardlink = hardlink
+
+    def process(self, record):
+        try:
+            transfer_file(
+                record.path, record.destination, self.delete_originals, self.hardlink
+            )
+        except OSError as e:
+            logger.warning(f"Failed to transfer {record.path}. Error: {e}")
+            return None
+        action = "Moved" if self.delete_originals else "Copied"
+        logger.info(f"{action} {record.path} to {record.destination}.")
+        record.path = record.destination
+        return record
+
+
+class Resizer(Stage):
+    """Save each record in every rendition, given as (max_dim, output_dir, format).
+
+    The paths of the saved renditions are added to the record's outputs. Videos and
+    other files Pillow cannot open are passed on without any. The options and their
+    defaults are those of ResizeOptions, so an existing rendition is only replaced
+    with force_overwrite.
+    """
+
+    def __init__(
+        self,
+        renditions,
+        resize_speed="balanced",
+        force_overwrite=False,
+        skip_existing=False,
+        delete_originals=False,
+        cache=None,
+    ):
+        self.cache = cache
+        self.options = ResizeOptions(
+            renditions,
+            resize_speed=resize_speed,
+            force_overwrite=force_overwrite,
+            skip_existing=skip_existing,
+            delete_originals=delete_originals,
+        )
+        self.destinations = DestinationIndex()
+
+    def process(self, record):
+        if not is_image_file(record.path):
+            return record
+        _, written = resize_file(
+            logger,
+            self.options,
+            self.cache,
+            record.path,
+            destinations=self.destinations,
+        )
+        record.outputs.extend(written)
+        return record
+
+
+class Uploader:
+    """Upload the outputs of records, or their path if they have none, to Google Photos.
+
+    Unlike the other stages this consumes all records at once, so that media items
+    can be created in batches. With an UploadLedger, files already in the library
+    are skipped. Returns (number uploaded, list of (path, error)).
+    """
+
+    def __init__(self, session, workers=DEFAULT_UPLOAD_WORKERS, ledger=None):
+        self.session = session
+        self.workers = workers
+        self.ledger = ledger
+
+    def __call__(self, records):
+        file_paths = []
+        for record in records:
+            file_paths.extend(record.outputs or [record.path])
+        return upload_all(self.session, file_paths, self.workers, self.ledger)
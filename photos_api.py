@@ -0,0 +1,308 @@
+import io
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+UPLOAD_URL = "https://photoslibrary.googleapis.com/v1/uploads"
+BATCH_CREATE_URL = "https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate"
+MEDIA_ITEMS_URL = "https://photoslibrary.googleapis.com/v1/mediaItems"
+
+# mediaItems:batchCreate accepts at most 50 items per call.
+BATCH_SIZE = 50
+DEFAULT_UPLOAD_WORKERS = 4
+
+REQUEST_TIMEOUT = 60
+UPLOAD_TIMEOUT = 300
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Responses to a request that was certainly not carried out, so that even one that
+# is not idempotent can be sent again.
+REJECTED_STATUS_CODES = (429,)
+
+# Uploads submitted ahead of the ones finished, per worker. Files are read from the
+# scan as uploads finish, rather than all queued up front.
+IN_FLIGHT_PER_WORKER = 4
+
+
+def request_with_retry(
+    session,
+    method,
+    url,
+    open_data=None,
+    timeout=REQUEST_TIMEOUT,
+    idempotent=True,
+    **kwargs,
+):
+    """Send a request, retrying with exponential backoff on transient failures.
+
+    Those are 429 and 5xx responses, connection errors and timeouts. A Retry-After
+    header on a failed response is waited out instead of the backoff. open_data, if
+    given, is called for every attempt to get the request body, so that file bodies
+    can be re-read. A request that is not idempotent, such as mediaItems:batchCreate,
+    may have been carried out when a 5xx or an error comes back, so it is only
+    retried after a 429 or a timeout while connecting.
+    """
+    retry_status_codes = RETRY_STATUS_CODES if idempotent else REJECTED_STATUS_CODES
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            if open_data is None:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+            else:
+                with open_data() as data:
+                    response = session.request(
+                        method, url, data=data, timeout=timeout, **kwargs
+                    )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            sent = not isinstance(e, requests.ConnectTimeout)
+            if attempt == MAX_RETRIES or (sent and not idempotent):
+                raise
+            time.sleep(BACKOFF_SECONDS * 2**attempt)
+            continue
+        if response.status_code not in retry_status_codes or attempt == MAX_RETRIES:
+            return response
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = float(retry_after)
+        else:
+            delay = BACKOFF_SECONDS * 2**attempt
+        response.close()
+        time.sleep(delay)
+
+
+def get_with_retry(session, url, **kwargs):
+    return request_with_retry(session, "GET", url, **kwargs)
+
+
+def sanitize_filename(filename):
+    """Sanitize filename to ensure it contains only ASCII characters."""
+    return filename.encode("ascii", errors="ignore").decode("ascii")
+
+
+def post_with_retry(session, url, open_data, headers, idempotent=True):
+    """POST to a URL with request_with_retry().
+
+    open_data is called for every attempt, so that file bodies can be re-read.
+    """
+    return request_with_retry(
+        session,
+        "POST",
+        url,
+        open_data=open_data,
+        timeout=UPLOAD_TIMEOUT,
+        idempotent=idempotent,
+        headers=headers,
+    )
+
+
+def upload_photo(session, file_path):
+    """Upload the bytes of a photo to Google Photos. Returns an upload token or None."""
+    sanitized_filename = sanitize_filename(os.path.basename(file_path))
+    headers = {
+        "Authorization": f"Bearer {session.credentials.token}",
+        "Content-type": "application/octet-stream",
+        "X-Goog-Upload-File-Name": sanitized_filename,
+        "X-Goog-Upload-Protocol": "raw",
+    }
+
+    response = post_with_retry(
+        session, UPLOAD_URL, lambda: open(file_path, "rb"), headers
+    )
+
+    if response.status_code == 200:
+        return response.content.decode("utf-8")
+    else:
+        print(f"Failed to upload {file_path}: {response.content}")
+        return None
+
+
+def create_media_items(session, uploads, description="Uploaded by script"):
+    """Create media items for up to BATCH_SIZE uploads in a single batchCreate call.
+
+    uploads is a list of (file_path, upload_token). Returns a list of
+    (file_path, media_item_id) for the items that were created, and a list of
+    (file_path, error) for those that could not be.
+    """
+    headers = {
+        "Authorization": f"Bearer {session.credentials.token}",
+        "Content-type": "application/json",
+    }
+    payload = json.dumps(
+        {
+            "newMediaItems": [
+                {
+                    "description": description,
+                    "simpleMediaItem": {"uploadToken": upload_token},
+                }
+                for _, upload_token in uploads
+            ]
+        }
+    )
+    # Creating the same items twice would duplicate them in the library, and upload
+    # tokens can only be used once, so a failed batch is left to the next round.
+    try:
+        response = post_with_retry(
+            session,
+            BATCH_CREATE_URL,
+            lambda: io.StringIO(payload),
+            headers,
+            idempotent=False,
+        )
+    except requests.RequestException as e:
+        print(f"Failed to create media items: {e}")
+        return [], [(file_path, str(e)) for file_path, _ in uploads]
+    if response.status_code not in (200, 207):
+        print(f"Failed to create media items: {response.content}")
+        return [], [(file_path, response.text) for file_path, _ in uploads]
+
+    # Each item has its own status; a 207 response means only some of them failed.
+    paths_by_token = {upload_token: file_path for file_path, upload_token in uploads}
+    created = []
+    failed = []
+    for result in response.json().get("newMediaItemResults", []):
+        file_path = paths_by_token.pop(result.get("uploadToken"), None)
+        if file_path is None:
+            continue
+        status = result.get("status", {})
+        if status.get("code", 0) != 0:
+            failed.append((file_path, status.get("message", "Unknown error")))
+        else:
+            created.append((file_path, result.get("mediaItem", {}).get("id")))
+    for file_path in paths_by_token.values():
+        failed.append((file_path, "Missing from response"))
+    return created, failed
+
+
+def list_all_media_items(session):
+    """List every media item in the library."""
+    headers = {"Authorization": f"Bearer {session.credentials.token}"}
+    media_items = []
+    params = {"pageSize": 100}
+    while True:
+        response = get_with_retry(
+            session, MEDIA_ITEMS_URL, headers=headers, params=params
+        )
+        if response.status_code != 200:
+            print(f"Failed to list media items: {response.content}")
+            break
+        data = response.json()
+        media_items.extend(data.get("mediaItems", []))
+        if not data.get("nextPageToken"):
+            break
+        params["pageToken"] = data["nextPageToken"]
+    return media_items
+
+
+def skip_uploaded(file_paths, ledger, workers=DEFAULT_UPLOAD_WORKERS):
+    """Check files against the ledger, hashing them as they come.
+
+    Yields (file_path, content_hash, uploaded), where uploaded is whether the ledger
+    shows the file is already in the library. Of several identical files, only the
+    first counts as not uploaded. content_hash is None for files that could not be
+    read, which are left to the upload to fail on.
+    """
+    seen = set()
+    for file_path, content_hash, error in ledger.content_hashes(file_paths, workers):
+        if error:
+            print(f"Failed to read {file_path}: {error}")
+            yield file_path, None, False
+            continue
+        filename = sanitize_filename(os.path.basename(file_path))
+        if content_hash in seen or ledger.media_item_for(
+            file_path, content_hash, filename
+        ):
+            yield file_path, content_hash, True
+            continue
+        seen.add(content_hash)
+        yield file_path, content_hash, False
+
+
+def upload_all(session, file_paths, workers=DEFAULT_UPLOAD_WORKERS, ledger=None):
+    """Upload files concurrently and create their media items in batches.
+
+    file_paths may be a generator; at most IN_FLIGHT_PER_WORKER uploads per worker
+    are waiting at a time. With an UploadLedger, files already in the library are
+    skipped, and every media item created is recorded in it.
+    Returns (number of successful uploads, list of (file_path, error) for failures).
+    """
+    hashes = {}
+    skipped = 0
+    if ledger:
+
+        def to_upload(file_paths):
+            nonlocal skipped
+            for file_path, content_hash, uploaded in skip_uploaded(
+                file_paths, ledger, workers
+            ):
+                if uploaded:
+                    skipped += 1
+                    continue
+                if content_hash:
+                    hashes[file_path] = content_hash
+                yield file_path
+
+        file_paths = to_upload(file_paths)
+
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    successful_uploads = 0
+    failed_uploads = []
+    batch = []
+
+    def commit_batch():
+        nonlocal successful_uploads
+        created, failed = create_media_items(session, batch)
+        failed_uploads.extend(failed)
+        successful_uploads += len(created)
+        print(f"Created {len(created)} of {len(batch)} media items.")
+        for file_path, media_item_id in created:
+            content_hash = hashes.pop(file_path, None)
+            if ledger and content_hash and media_item_id:
+                ledger.record(file_path, content_hash, media_item_id)
+        for file_path, _ in failed:
+            hashes.pop(file_path, None)
+        if ledger:
+            ledger.commit()
+        batch.clear()
+
+    def finish_upload(future):
+        file_path = in_flight.pop(future)
+        try:
+            upload_token = future.result()
+        except Exception as e:
+            print(f"Error uploading {file_path}: {e}")
+            upload_token = None
+            error = str(e)
+        else:
+            error = "Upload failed"
+        if not upload_token:
+            hashes.pop(file_path, None)
+            failed_uploads.append((file_path, error))
+            return
+        batch.append((file_path, upload_token))
+        if len(batch) == BATCH_SIZE:
+            commit_batch()
+
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file_path in file_paths:
+            while len(in_flight) >= workers * IN_FLIGHT_PER_WORKER:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish_upload(future)
+            print(f"Uploading {file_path}...")
+            in_flight[executor.submit(upload_photo, session, file_path)] = file_path
+        for future in as_completed(list(in_flight)):
+            finish_upload(future)
+    if batch:
+        commit_batch()
+    if skipped:
+        print(f"Skipped {skipped} files already in the library.")
+
+    return successful_uploads, failed_uploads
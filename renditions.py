@@ -0,0 +1,250 @@
+import os
+from dataclasses import dataclass
+
+from PIL import Image
+from PIL.ExifTags import TAGS
+
+from dedup import DestinationIndex
+from file_transfer import copy_file
+from metadata_cache import cached_date_time
+from metadata_extractors import NO_DATE, read_date_time
+from metrics import NO_METRICS
+
+img_formats = [".png", ".jpg", ".jpeg"]
+
+# Output formats that a rendition can be converted to.
+format_extensions = {"jpeg": ".jpg", "jpg": ".jpg", "png": ".png", "webp": ".webp"}
+
+
+@dataclass
+class ResizeOptions:
+    """How resize_file() saves an image.
+
+    renditions are (max_dim, output_directory, format) tuples, with a format of None
+    to keep the original one. They are kept largest first, so that each rendition
+    can be resized from the previous one. With skip_existing, a rendition whose name
+    is taken is not saved; otherwise it replaces the existing file if force_overwrite
+    is set, and gets a _RESIZED suffix if not.
+    """
+
+    renditions: list
+    resize_speed: str = "balanced"
+    force_overwrite: bool = False
+    skip_existing: bool = False
+    delete_originals: bool = False
+
+    def __post_init__(self):
+        self.renditions = sorted(
+            [
+                (max_dim, os.path.abspath(output_directory), image_format)
+                for max_dim, output_directory, image_format in self.renditions
+            ],
+            key=lambda rendition: -rendition[0],
+        )
+
+
+def is_image_file(filepath):
+    return os.path.splitext(filepath)[-1].lower() in img_formats
+
+
+def extract_date_time(filepath, image):
+    """Return the EXIF DateTimeOriginal of an opened image, or None."""
+    # Read only the file header if possible, falling back to Pillow's EXIF parser.
+    date_time = read_date_time(filepath)
+    if date_time == NO_DATE:
+        return None
+    if date_time is not None:
+        return date_time
+    try:
+        exif_data = image._getexif()
+    except Exception:
+        return None
+    if exif_data:
+        for tag, value in exif_data.items():
+            tag_name = TAGS.get(tag, tag)
+            if tag_name == "DateTimeOriginal":
+                return value
+    return None
+
+
+def resize_image(image, size, speed="balanced"):
+    """Resize an opened image to size.
+
+    "quality" decodes the full image and resamples it in one step. "balanced" lets the
+    JPEG decoder downscale by 1/2, 1/4 or 1/8 in the DCT domain while staying above
+    the target size, then finishes with a bicubic resize. "fast" does the same but
+    reduces more aggressively before a bilinear resize.
+    """
+    if speed == "quality":
+        return image.resize(size)
+    image.draft(image.mode, size)
+    if speed == "fast":
+        return image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return image.resize(size, Image.Resampling.BICUBIC, reducing_gap=3.0)
+
+
+def save_image(logger, image, filepath, exif, image_format=None, temp=None):
+    """Save image as filepath, or with temp, to temp in the format filepath implies."""
+    if image_format == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    extension = os.path.splitext(filepath)[1].lower()
+    save_format = Image.registered_extensions().get(extension)
+    target = temp or filepath
+    try:
+        image.save(target, save_format, exif=exif)
+    except:
+        logger.warning(f"No EXIF data found.")
+        image.save(target, save_format)
+
+
+def destination_path(
+    logger, options, output_directory, year, filepath, image_format, destinations
+):
+    """Return where to save a rendition of filepath, or None to skip it.
+
+    Names are checked against the DestinationIndex destinations rather than the disk,
+    and the name returned is reserved in it.
+    """
+    year_directory = os.path.join(output_directory, year)
+    file_name = os.path.basename(filepath)
+    if image_format:
+        file_name = os.path.splitext(file_name)[0] + format_extensions[image_format]
+
+    # The Resizer stage resizes on several threads with one index.
+    with destinations.lock:
+        # Create the year directory or "Other" directory if it doesn't exist
+        if destinations.ensure_directory(year_directory):
+            logger.info(f"Created directory: {year_directory}")
+
+        duplicate_exists = destinations.exists(year_directory, file_name)
+        if duplicate_exists and options.skip_existing:
+            return None
+        if not options.force_overwrite:
+            while duplicate_exists:
+                stem, ext = os.path.splitext(file_name)
+                file_name = stem + "_RESIZED" + ext
+                duplicate_exists = destinations.exists(year_directory, file_name)
+        return destinations.reserve(year_directory, file_name)
+
+
+def resize_file(
+    logger, options, cache, f, batch=None, metrics=NO_METRICS, destinations=None
+):
+    """Produce every rendition in options.renditions for the image f.
+
+    Returns (resized, written): whether at least one rendition was resized, and the
+    paths of all renditions that were saved, including plain copies of images that
+    were already small enough. With a DurableBatch, the renditions are written under
+    temporary names, and the original is only deleted once they have been committed.
+    destinations is the DestinationIndex of the output directories, which should be
+    shared by every call in a run.
+    """
+    if destinations is None:
+        destinations = DestinationIndex()
+    written = []
+    entry = cache.get(f) if cache else None
+    known, date_time = cached_date_time(entry)
+
+    # With a complete cache entry the image is only opened if it needs resizing.
+    image = None
+    if known and entry["width"] is not None:
+        size = (entry["width"], entry["height"])
+    else:
+        logger.info(f"Opening image: {f}...")
+        try:
+            with metrics.time("open"):
+                image = Image.open(f)
+        except Exception as e:
+            logger.warning(f"Failed to open file {f}")
+            logger.debug(e)
+            metrics.count("failed_open")
+            return False, written
+        size = image.size
+
+        if not known:
+            with metrics.time("parse"):
+                date_time = extract_date_time(f, image)
+        if cache:
+            cache.put(f, date_time=date_time or "", width=size[0], height=size[1])
+
+    if date_time:
+        year = date_time.split(":")[0]  # Extract the year from DateTimeOriginal
+    else:
+        logger.warning(f"Failed to find suitable EXIF data to organize for {f}.")
+        year = "Other"
+
+    targets = []
+    for max_dim, output_directory, image_format in options.renditions:
+        with metrics.time("destination"):
+            new_filepath = destination_path(
+                logger, options, output_directory, year, f, image_format, destinations
+            )
+        if new_filepath is not None:
+            targets.append((max_dim, new_filepath, image_format))
+    if not targets:
+        metrics.count("skipped_existing")
+        return False, written
+
+    x, y = size
+    biggest_dim = x if x > y else y
+
+    needs_decode = any(
+        max_dim <= biggest_dim or image_format
+        for max_dim, _, image_format in targets
+    )
+    if image is None and needs_decode:
+        logger.info(f"Opening image: {f}...")
+        try:
+            with metrics.time("open"):
+                image = Image.open(f)
+        except Exception as e:
+            logger.warning(f"Failed to open file {f}")
+            logger.debug(e)
+            metrics.count("failed_open")
+            return False, written
+
+    # Renditions are in decreasing size, so each one is resized from the previous
+    # one rather than decoding the original again.
+    exif = image.info.get("exif") if image is not None else None
+    current = image
+    resized = False
+    outputs = []
+    for max_dim, new_filepath, image_format in targets:
+        temp = batch.temp_path(new_filepath) if batch else None
+        outputs.append((temp, new_filepath))
+        if max_dim > biggest_dim:
+            logger.warning(
+                f"Images can only be reduced in size. Max dimension {max_dim} is greater than image size = {size}"
+            )
+            with metrics.time("save"):
+                if image_format:
+                    save_image(logger, image, new_filepath, exif, image_format, temp)
+                else:
+                    copy_file(f, temp or new_filepath)
+            written.append(new_filepath)
+            metrics.count("copied")
+            continue
+
+        ratio = max_dim / float(biggest_dim)
+        new_x = ratio * x
+        new_y = ratio * y
+
+        # The first resize also decodes the image, which Image.open leaves until needed.
+        with metrics.time("resize"):
+            current = resize_image(
+                current, (int(new_x), int(new_y)), options.resize_speed
+            )
+        with metrics.time("save"):
+            save_image(logger, current, new_filepath, exif, image_format, temp)
+        logger.info(f"Resized {f} to {new_filepath}.")
+        written.append(new_filepath)
+        metrics.count("resized")
+        resized = True
+
+    if batch is not None:
+        batch.add(outputs, f, resized and options.delete_originals)
+    elif resized and options.delete_originals:
+        os.remove(f)
+        logger.info(f"Deleted original image: {f}")
+
+    return resized, written
@@ -0,0 +1,289 @@
+"""Tests of the header-only date readers, on small files built here byte by byte."""
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from metadata_extractors import (
+    EXTRACTORS,
+    NO_DATE,
+    QUICKTIME_EPOCH,
+    _parse_iloc,
+    read_date_time,
+)
+
+DATE = "2019:05:06 07:08:09"
+
+
+def tiff_block(date_time=DATE, endian="<"):
+    """A TIFF block holding DateTimeOriginal in its Exif IFD, or no Exif IFD at all."""
+    order = b"II*\x00" if endian == "<" else b"MM\x00*"
+    header = order + struct.pack(endian + "I", 8)
+    if date_time is None:
+        return header + struct.pack(endian + "HI", 0, 0)
+    value = date_time.encode("ascii") + b"\x00"
+    exif_ifd = 8 + 18
+    ifd0 = struct.pack(endian + "HHHII", 1, 0x8769, 4, 1, exif_ifd) + b"\x00" * 4
+    value_offset = exif_ifd + 18
+    exif = struct.pack(endian + "HHHII", 1, 0x9003, 2, len(value), value_offset)
+    return header + ifd0 + exif + b"\x00" * 4 + value
+
+
+def jpeg(tiff=None):
+    """A JPEG whose metadata segments end at the start of scan."""
+    segments = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00" + b"\x00" * 9
+    if tiff is not None:
+        payload = b"Exif\x00\x00" + tiff
+        segments += b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+    return b"\xff\xd8" + segments + b"\xff\xda" + struct.pack(">H", 2) + b"\xff\xd9"
+
+
+def png(tiff=None):
+    def chunk(chunk_type, data):
+        crc = zlib.crc32(chunk_type + data)
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+    chunks = chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+    if tiff is not None:
+        chunks += chunk(b"eXIf", tiff)
+    return b"\x89PNG\r\n\x1a\n" + chunks + chunk(b"IDAT", b"") + chunk(b"IEND", b"")
+
+
+def box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, version, payload):
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def infe(version, item_id, item_type):
+    id_format = ">H" if version == 2 else ">I"
+    entry = struct.pack(id_format, item_id) + b"\x00\x00" + item_type + b"\x00"
+    return full_box(b"infe", version, entry)
+
+
+def iloc(version, items, construction_method=0):
+    """An iloc box; items are (item id, base offset, [(offset, length), ...])."""
+    index_size = 4 if version in (1, 2) else 0
+    id_format = ">H" if version < 2 else ">I"
+    data = bytes([0x44, 0x40 | index_size]) + struct.pack(id_format, len(items))
+    for item_id, base_offset, extents in items:
+        data += struct.pack(id_format, item_id)
+        if version in (1, 2):
+            data += struct.pack(">H", construction_method)
+        data += struct.pack(">HIH", 0, base_offset, len(extents))
+        for offset, length in extents:
+            data += b"\x00" * index_size + struct.pack(">II", offset, length)
+    return full_box(b"iloc", version, data)
+
+
+def heif(
+    tiff=None,
+    iloc_version=0,
+    infe_version=2,
+    extents=1,
+    construction_method=0,
+    truncate_iloc=0,
+):
+    """A HEIC file with an hvc1 item and, if tiff is given, an Exif item in mdat.
+
+    The Exif item is split into the given number of extents, stored back to front
+    so that reading them in order is not the same as reading the file in order.
+    """
+    exif_item = struct.pack(">I", 6) + b"Exif\x00\x00" + (tiff or b"")
+    size = -(-len(exif_item) // extents)
+    pieces = [exif_item[i : i + size] for i in range(0, len(exif_item), size)]
+    entries = [infe(infe_version, 1, b"hvc1")]
+    if tiff is not None:
+        entries.append(infe(infe_version, 2, b"Exif"))
+    iinf_version = 0 if infe_version == 2 else 1
+    count_format = ">H" if iinf_version == 0 else ">I"
+    entry_count = struct.pack(count_format, len(entries))
+    iinf = full_box(b"iinf", iinf_version, entry_count + b"".join(entries))
+    ftyp = box(b"ftyp", b"heic\x00\x00\x00\x00mif1heic")
+
+    def meta(mdat_start):
+        # Later pieces come first in mdat, each extent pointing at its own piece.
+        offsets, position = [], 0
+        for piece in reversed(pieces):
+            offsets.insert(0, position)
+            position += len(piece)
+        item_extents = [(offset, len(piece)) for offset, piece in zip(offsets, pieces)]
+        items = [(1, mdat_start, [(0, 0)])]
+        if tiff is not None:
+            items.append((2, mdat_start, item_extents))
+        location = iloc(iloc_version, items, construction_method)
+        if truncate_iloc:
+            location = box(b"iloc", location[8:-truncate_iloc])
+        return full_box(b"meta", 0, box(b"hdlr", b"\x00" * 24) + iinf + location)
+
+    mdat_start = len(ftyp) + len(meta(0)) + 8
+    return ftyp + meta(mdat_start) + box(b"mdat", b"".join(reversed(pieces)))
+
+
+def quicktime_seconds(year, month, day):
+    start = datetime(year, month, day, tzinfo=timezone.utc)
+    return int((start - QUICKTIME_EPOCH).total_seconds())
+
+
+def local_date(seconds):
+    created = QUICKTIME_EPOCH + timedelta(seconds=seconds)
+    return created.astimezone().strftime("%Y:%m:%d %H:%M:%S")
+
+
+def mvhd(version, seconds):
+    if version == 1:
+        times = struct.pack(">QQIQ", seconds, seconds, 1000, 0)
+    else:
+        times = struct.pack(">IIII", seconds, seconds, 1000, 0)
+    return full_box(b"mvhd", version, times + b"\x00" * 80)
+
+
+def mp4(version=0, seconds=None, large_mdat=False, open_ended_mdat=False):
+    """An MP4 with the movie header after the media data, as cameras write it."""
+    if seconds is None:
+        seconds = quicktime_seconds(2020, 1, 2)
+    ftyp = box(b"ftyp", b"isom\x00\x00\x00\x00isom")
+    moov = box(b"moov", mvhd(version, seconds))
+    media = b"\x00" * 100
+    if open_ended_mdat:
+        # A size of 0 runs to the end of the file, so moov has to come first.
+        return ftyp + moov + struct.pack(">I4s", 0, b"mdat") + media
+    if large_mdat:
+        mdat = struct.pack(">I4sQ", 1, b"mdat", 16 + len(media)) + media
+    else:
+        mdat = box(b"mdat", media)
+    return ftyp + mdat + moov
+
+
+class ReadDateTimeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def read(self, data, name="file", max_bytes=None):
+        filepath = os.path.join(self.directory.name, name)
+        with open(filepath, "wb") as f:
+            f.write(data)
+        if max_bytes is None:
+            return read_date_time(filepath)
+        return read_date_time(filepath, max_bytes)
+
+    def test_every_registered_format_is_covered(self):
+        fixtures = {
+            "jpeg": jpeg(tiff_block()),
+            "png": png(tiff_block()),
+            "tiff": tiff_block(),
+            "isobmff": heif(tiff_block()),
+        }
+        self.assertEqual({extractor.name for extractor in EXTRACTORS}, set(fixtures))
+        for extractor in EXTRACTORS:
+            for extension in extractor.extensions:
+                with self.subTest(extension=extension):
+                    data = fixtures[extractor.name]
+                    self.assertEqual(self.read(data, "file" + extension), DATE)
+
+    def test_format_is_picked_by_content(self):
+        self.assertEqual(self.read(heif(tiff_block()), "photo.jpg"), DATE)
+        self.assertIsNone(self.read(b"not a photo at all", "photo.jpg"))
+
+    def test_jpeg(self):
+        self.assertEqual(self.read(jpeg(tiff_block(endian=">"))), DATE)
+        self.assertEqual(self.read(jpeg()), NO_DATE)
+        self.assertEqual(self.read(jpeg(tiff_block(None))), NO_DATE)
+
+    def test_truncated_jpeg(self):
+        data = jpeg(tiff_block())
+        # Cut inside the segment headers, inside the Exif block and inside the date.
+        for size in (3, 30, len(data) - 12):
+            with self.subTest(size=size):
+                self.assertIsNone(self.read(data[:size]))
+
+    def test_png(self):
+        self.assertEqual(self.read(png(tiff_block())), DATE)
+        self.assertEqual(self.read(png()), NO_DATE)
+        self.assertIsNone(self.read(png(tiff_block())[:40]))
+
+    def test_tiff(self):
+        self.assertEqual(self.read(tiff_block(endian=">")), DATE)
+        self.assertEqual(self.read(tiff_block(None)), NO_DATE)
+
+    def test_truncated_tiff(self):
+        data = tiff_block()
+        for size in (16, 30, len(data) - 5):
+            with self.subTest(size=size):
+                self.assertIsNone(self.read(data[:size]))
+        self.assertIsNone(self.read(data, max_bytes=40))
+
+    def test_heif_item_info_and_location_versions(self):
+        for iloc_version in (0, 1, 2):
+            for infe_version in (2, 3):
+                with self.subTest(iloc=iloc_version, infe=infe_version):
+                    data = heif(
+                        tiff_block(),
+                        iloc_version=iloc_version,
+                        infe_version=infe_version,
+                    )
+                    self.assertEqual(self.read(data), DATE)
+
+    def test_heif_without_exif(self):
+        self.assertEqual(self.read(heif()), NO_DATE)
+        self.assertEqual(self.read(heif(tiff_block(None))), NO_DATE)
+
+    def test_heif_multiple_extents(self):
+        for iloc_version in (0, 1, 2):
+            with self.subTest(iloc=iloc_version):
+                data = heif(tiff_block(), iloc_version=iloc_version, extents=3)
+                self.assertEqual(self.read(data), DATE)
+
+    def test_parse_iloc_multiple_extents(self):
+        location = iloc(1, [(7, 1000, [(0, 10), (50, 20)])])
+        self.assertEqual(_parse_iloc(location[8:]), {7: [(1000, 10), (1050, 20)]})
+
+    def test_heif_item_outside_the_file(self):
+        # Construction method 1 stores the item in an idat box, which is not read.
+        data = heif(tiff_block(), iloc_version=1, construction_method=1)
+        self.assertIsNone(self.read(data))
+
+    def test_truncated_heif(self):
+        self.assertIsNone(self.read(heif(tiff_block(), truncate_iloc=4)))
+        data = heif(tiff_block())
+        # Cut inside meta, and inside the Exif item in mdat.
+        for size in (60, len(data) - 10):
+            with self.subTest(size=size):
+                self.assertIsNone(self.read(data[:size]))
+
+    def test_mp4(self):
+        seconds = quicktime_seconds(2020, 1, 2)
+        expected = local_date(seconds)
+        self.assertEqual(self.read(mp4(0, seconds)), expected)
+        self.assertEqual(self.read(mp4(0, seconds, large_mdat=True)), expected)
+        self.assertEqual(self.read(mp4(0, seconds, open_ended_mdat=True)), expected)
+
+    def test_mp4_64_bit_times(self):
+        # Past 2040, creation times no longer fit in the 32 bits of version 0.
+        seconds = quicktime_seconds(2050, 3, 4)
+        self.assertGreater(seconds, 2**32)
+        self.assertEqual(self.read(mp4(1, seconds)), local_date(seconds))
+
+    def test_mp4_without_date(self):
+        self.assertEqual(self.read(mp4(0, 0)), NO_DATE)
+        self.assertEqual(self.read(mp4(1, 0)), NO_DATE)
+
+    def test_truncated_mp4(self):
+        data = mp4(1)
+        # Cut inside mdat, before the movie header, and inside its creation time.
+        for size in (40, len(data) - 110):
+            with self.subTest(size=size):
+                self.assertIsNone(self.read(data[:size]))
+
+    def test_box_smaller_than_its_header(self):
+        data = box(b"ftyp", b"isom\x00\x00\x00\x00") + struct.pack(">I4s", 4, b"moov")
+        self.assertIsNone(self.read(data + mp4()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,225 @@
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+from PIL import Image
+
+from file_hash import DEFAULT_WORKERS, hash_files
+from metadata_extractors import read_date_time
+
+LEDGER_FILENAME = ".upload_ledger.sqlite"
+
+# Commit to disk every this many writes, so an interrupted run keeps most of its work.
+COMMIT_INTERVAL = 100
+
+# Files looked up and hashed together by content_hashes().
+HASH_WINDOW = 256
+
+# Library items keep their creation time in UTC, and local capture dates carry no
+# time zone, so the two can differ by up to the largest UTC offset.
+MAX_CLOCK_OFFSET = timedelta(hours=14)
+
+
+class UploadLedger:
+    """Record of which files have already been uploaded to Google Photos.
+
+    Uploads are keyed by content hash, so a file that was moved or renamed since it
+    was uploaded is still recognised. The hash of each local file is kept with its
+    size and mtime, and is only recomputed when those change.
+
+    The ledger can be seeded with a mediaItems listing of the library. Listings carry
+    no content hash, so a file is taken to be a seeded item if it has the same name,
+    the same width and height, and a capture date within MAX_CLOCK_OFFSET of the
+    item's creation time. Its hash is then recorded against the item, which is not
+    matched to any other file after that.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS uploads (
+                content_hash TEXT PRIMARY KEY,
+                media_item_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                uploaded_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS library (
+                media_item_id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                creation_time TEXT,
+                width INTEGER,
+                height INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS library_filename ON library (filename);
+            CREATE INDEX IF NOT EXISTS uploads_media_item_id ON uploads (media_item_id);
+            """
+        )
+        # Ledgers seeded before items were matched on their metadata lack it. Their
+        # items never match until the library is seeded again.
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(library)")}
+        for column, column_type in (
+            ("creation_time", "TEXT"),
+            ("width", "INTEGER"),
+            ("height", "INTEGER"),
+        ):
+            if column not in columns:
+                self.connection.execute(
+                    f"ALTER TABLE library ADD COLUMN {column} {column_type}"
+                )
+        self.pending_writes = 0
+
+    @classmethod
+    def in_directory(cls, directory):
+        return cls(os.path.join(directory, LEDGER_FILENAME))
+
+    def content_hashes(self, filepaths, workers=DEFAULT_WORKERS):
+        """Yield (filepath, SHA-256, error) for each file, in order.
+
+        The stored hash is reused for files whose size and mtime are unchanged. The
+        others are hashed on a thread pool of workers, and their hashes stored.
+        filepaths may be a generator, and is read HASH_WINDOW files at a time.
+        """
+        filepaths = iter(filepaths)
+        while True:
+            window = list(islice(filepaths, HASH_WINDOW))
+            if not window:
+                return
+            yield from self._content_hashes(window, workers)
+
+    def _content_hashes(self, filepaths, workers):
+        known = {}
+        stats = {}
+        for filepath in filepaths:
+            path = os.path.abspath(filepath)
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                known[filepath] = (None, e)
+                continue
+            row = self.connection.execute(
+                "SELECT content_hash FROM files "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+            if row:
+                known[filepath] = (row[0], None)
+            else:
+                stats[filepath] = stat
+
+        # Keyed by path, as a path listed twice is hashed only once.
+        for filepath, digest, error in hash_files(list(stats), workers=workers):
+            known[filepath] = (digest, error)
+            if digest:
+                stat = stats[filepath]
+                self._write(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                    (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns, digest),
+                )
+        for filepath in filepaths:
+            yield (filepath,) + known[filepath]
+
+    def media_item_for(self, filepath, content_hash, filename=None):
+        """Return the id of the media item already holding this file, or None.
+
+        filename is the name the file would be uploaded under, and defaults to its
+        base name.
+        """
+        row = self.connection.execute(
+            "SELECT media_item_id FROM uploads WHERE content_hash = ?", (content_hash,)
+        ).fetchone()
+        if row:
+            return row[0]
+        # Seeded items that no other file has been matched to yet.
+        candidates = self.connection.execute(
+            "SELECT media_item_id, creation_time, width, height FROM library "
+            "WHERE filename = ? AND media_item_id NOT IN "
+            "(SELECT media_item_id FROM uploads)",
+            (filename or os.path.basename(filepath),),
+        ).fetchall()
+        if not candidates:
+            return None
+        date_time, size = _local_metadata(filepath)
+        for media_item_id, creation_time, width, height in candidates:
+            if size is None or size != (width, height):
+                continue
+            if date_time and not _close_in_time(date_time, creation_time):
+                continue
+            self.record(filepath, content_hash, media_item_id)
+            return media_item_id
+        return None
+
+    def record(self, filepath, content_hash, media_item_id):
+        self._write(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)",
+            (content_hash, media_item_id, os.path.abspath(filepath), time.time()),
+        )
+
+    def seed(self, media_items):
+        """Add media items, as returned by the mediaItems API, to the known library.
+
+        Returns the number of items that were not known before. Items already known
+        have their metadata updated.
+        """
+        (known,) = self.connection.execute("SELECT COUNT(*) FROM library").fetchone()
+        for item in media_items:
+            metadata = item.get("mediaMetadata", {})
+            width, height = metadata.get("width"), metadata.get("height")
+            self._write(
+                "INSERT OR REPLACE INTO library VALUES (?, ?, ?, ?, ?)",
+                (
+                    item["id"],
+                    item["filename"],
+                    metadata.get("creationTime"),
+                    int(width) if width else None,
+                    int(height) if height else None,
+                ),
+            )
+        self.commit()
+        (total,) = self.connection.execute("SELECT COUNT(*) FROM library").fetchone()
+        return total - known
+
+    def _write(self, sql, parameters):
+        cursor = self.connection.execute(sql, parameters)
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_INTERVAL:
+            self.commit()
+        return cursor
+
+    def commit(self):
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def _local_metadata(filepath):
+    """Return the capture date and (width, height) of a file, each None if unknown."""
+    date_time = read_date_time(filepath) or None
+    try:
+        with Image.open(filepath) as image:
+            size = image.size
+    except OSError:
+        size = None
+    return date_time, size
+
+
+def _close_in_time(date_time, creation_time):
+    """Return whether an EXIF date and a library creation time can be the same moment."""
+    try:
+        taken = datetime.strptime(date_time, "%Y:%m:%d %H:%M:%S")
+        created = datetime.fromisoformat(creation_time.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return False
+    return abs(taken - created.replace(tzinfo=None)) <= MAX_CLOCK_OFFSET